@@ -0,0 +1,577 @@
+"""
+Render backends used by QVNCWidget to display the remote framebuffer
+
+(c) zocker-160 2024
+licensed under GPLv3
+"""
+
+import logging
+import time
+
+from PyQt5 import sip
+from PyQt5.QtCore import (
+    QT_VERSION,
+    QRect,
+    QRectF,
+    QSize,
+    QTimer,
+    Qt
+)
+from PyQt5.QtGui import (
+    QImage,
+    QOpenGLBuffer,
+    QOpenGLPixelTransferOptions,
+    QOpenGLShader,
+    QOpenGLShaderProgram,
+    QOpenGLTexture,
+    QOpenGLVersionProfile,
+    QPaintEvent,
+    QPainter,
+    QPixmap,
+    QVector2D
+)
+from PyQt5.QtWidgets import (
+    QWidget,
+    QOpenGLWidget
+)
+
+from qvncwidget.rfbhelpers import HOST_BIGENDIAN, RFBFramebuffer, RFBTripleBuffer
+
+log = logging.getLogger("QVNCWidget backends")
+
+GL_COLOR_BUFFER_BIT = 0x4000
+GL_TRIANGLE_STRIP = 0x0005
+
+# QOpenGLTexture.setData() with offsets needs Qt 5.14,
+# older versions upload the whole frame every time
+TEXTURE_SUBIMAGE = QT_VERSION >= 0x050e00
+
+# scaling modes
+SCALING_ADAPTIVE = 0 # fast while updating or resizing, smooth when idle
+SCALING_SMOOTH   = 1
+SCALING_FAST     = 2
+SCALING_NONE     = 3 # 1:1, no scaling at all
+
+class RenderBackend:
+    """
+    Widgets QVNCWidget displays the remote screen with. A backend fills
+    the whole QVNCWidget, paints the newest frame of the triple buffer it
+    has been given and leaves all input handling to QVNCWidget.
+    """
+    name: str = None
+
+    def _initBackend(self, scaling: int):
+        self.scaling = scaling
+        self._tripleBuffer: RFBTripleBuffer = None
+
+        self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.setMinimumSize(1, 1)
+
+    @classmethod
+    def supportsFormat(cls, imageFormat: QImage.Format) -> bool:
+        """
+        whether frames can be painted in this format, QVNCWidget
+        converts them to Format_RGB32 otherwise
+        """
+        return True
+
+    def setFrames(self, tripleBuffer: RFBTripleBuffer, imageFormat: QImage.Format):
+        """
+        called from the RFB thread for every new connection, desktop size
+        or pixel format
+        """
+        self._tripleBuffer = tripleBuffer
+
+    def setScaling(self, scaling: int):
+        self.scaling = scaling
+        self.update()
+
+    def scale(self) -> float:
+        """
+        factor between remote and widget coordinates
+        """
+        tripleBuffer = self._tripleBuffer
+        if tripleBuffer is None or self.scaling == SCALING_NONE:
+            return 1.0
+        return min(self.width() / tripleBuffer.width,
+                   self.height() / tripleBuffer.height)
+
+    @classmethod
+    def benchmark(cls, width = 1280, height = 720, frames = 20) -> float:
+        """
+        seconds per frame for a typical mix of full and partial updates
+        scaled to 3/4 of the remote size, None if the backend is unusable
+        """
+        backend = cls(None)
+        backend.resize(width * 3 // 4, height * 3 // 4)
+
+        source = RFBFramebuffer(width, height, 4)
+        tripleBuffer = RFBTripleBuffer(width, height, 4)
+        backend.setFrames(tripleBuffer, QImage.Format.Format_RGB32)
+
+        try:
+            if not backend._prepareBenchmark():
+                return None
+
+            start = time.perf_counter()
+            for frame in range(frames):
+                # some windows being updated, first frame is a full one
+                if frame == 0:
+                    rects = [(0, 0, width, height)]
+                else:
+                    rects = [
+                        ((frame * 97 + i * 211) % (width - 200),
+                         (frame * 53 + i * 127) % (height - 150), 200, 150)
+                        for i in range(8)
+                    ]
+                for rect in rects:
+                    source.fill(*rect, bytes((frame * 40 % 256, 128, 255 - frame, 0)))
+                tripleBuffer.publish(source, rects)
+                backend._renderBenchmarkFrame()
+
+            return (time.perf_counter() - start) / frames
+        except Exception as e:
+            log.debug(f"Benchmark of {cls.name} failed: {e}")
+            return None
+        finally:
+            backend.deleteLater()
+
+    def _prepareBenchmark(self) -> bool:
+        return True
+
+    def _renderBenchmarkFrame(self):
+        raise NotImplementedError
+
+class RasterBackend(QWidget, RenderBackend):
+    """
+    paints QImages with QPainter, scaled images are cached and only the
+    changed parts are rescaled
+    """
+    name = "raster"
+
+    # dirty areas get rescaled with this many extra pixels around them,
+    # so smooth filtering at their borders matches a full rescale
+    RESCALE_MARGIN = 2
+    # rescale everything when more than this part of the screen changed
+    FULL_RESCALE_RATIO = 0.5
+
+    def __init__(self, parent: QWidget, scaling = SCALING_ADAPTIVE, smoothDelay = 300):
+        super().__init__(parent)
+        self._initBackend(scaling)
+
+        # the GUI thread paints from QImages on top of the triple buffer
+        self._frames: tuple = None # (RFBTripleBuffer, list[QImage])
+        self.backbuffer: QImage = None # frame currently painted
+        self.frontbuffer: QImage = None # cached scaled backbuffer
+
+        # areas of the frontbuffer which have only been scaled fast yet
+        self._roughRects = list()
+        self._smoothPass = False
+        self._smoothTimer = QTimer(self)
+        self._smoothTimer.setSingleShot(True)
+        self._smoothTimer.setInterval(smoothDelay)
+        self._smoothTimer.timeout.connect(self._startSmoothPass)
+
+    def setFrames(self, tripleBuffer: RFBTripleBuffer, imageFormat: QImage.Format):
+        images = [
+            QImage(buffer.data, buffer.width, buffer.height, buffer.stride, imageFormat)
+            for buffer in tripleBuffer.buffers
+        ]
+        self._frames = (tripleBuffer, images)
+        super().setFrames(tripleBuffer, imageFormat)
+
+    def setScaling(self, scaling: int):
+        self.frontbuffer = None
+        super().setScaling(scaling)
+
+    def paintEvent(self, a0: QPaintEvent):
+        painter = QPainter(self)
+
+        frames = self._frames
+        if frames is None:
+            painter.fillRect(0, 0, self.width(), self.height(), Qt.GlobalColor.black)
+        else:
+            # newest published frame, the RFB thread leaves it alone until
+            # the next acquire() so no locking is needed while painting
+            tripleBuffer, images = frames
+            index, dirty = tripleBuffer.acquire()
+            self.backbuffer = images[index]
+            self._paintFrame(painter, dirty)
+
+        painter.end()
+
+    def _paintFrame(self, painter: QPainter, dirty: list):
+        if self.scaling == SCALING_NONE:
+            painter.drawImage(0, 0, self.backbuffer)
+        else:
+            self._updateFrontbuffer(dirty)
+            painter.drawImage(0, 0, self.frontbuffer)
+
+    def _getTransformation(self) -> Qt.TransformationMode:
+        if self.scaling == SCALING_FAST or \
+                (self.scaling == SCALING_ADAPTIVE and not self._smoothPass):
+            return Qt.TransformationMode.FastTransformation
+        return Qt.TransformationMode.SmoothTransformation
+
+    def _startSmoothPass(self):
+        self._smoothPass = True
+        self.update()
+
+    def _updateFrontbuffer(self, dirty: list) -> list:
+        """
+        brings the cached scaled image up to date, only the changed parts
+        are rescaled unless the widget size changed.
+        Returns the changed areas of the frontbuffer.
+        """
+        backbuffer = self.backbuffer
+        size = backbuffer.size().scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+        screen = backbuffer.rect()
+        dirty = [QRect(*rect).intersected(screen) for rect in dirty]
+
+        transformation = self._getTransformation()
+        if self._smoothPass:
+            dirty += self._roughRects
+            self._roughRects = list()
+            self._smoothPass = False
+
+        changed = sum(rect.width() * rect.height() for rect in dirty)
+        if self.frontbuffer is None or self.frontbuffer.size() != size \
+                or changed > screen.width() * screen.height() * self.FULL_RESCALE_RATIO:
+            self.frontbuffer = backbuffer.scaled(
+                size,
+                Qt.AspectRatioMode.IgnoreAspectRatio,
+                transformation
+            )
+            dirty = [screen]
+            changedFront = [self.frontbuffer.rect()]
+        else:
+            painter = QPainter(self.frontbuffer)
+            changedFront = [
+                self._rescaleRect(painter, backbuffer, rect, transformation)
+                for rect in dirty if not rect.isEmpty()
+            ]
+            painter.end()
+
+        if transformation == Qt.TransformationMode.FastTransformation \
+                and self.scaling == SCALING_ADAPTIVE and dirty:
+            self._roughRects.extend(dirty)
+            if len(self._roughRects) > 64:
+                self._roughRects = [screen]
+            # (re)start waiting for things to calm down
+            self._smoothTimer.start()
+
+        return changedFront
+
+    def _rescaleRect(self, painter: QPainter, backbuffer: QImage, rect: QRect,
+            transformation: Qt.TransformationMode) -> QRect:
+        scaleX = self.frontbuffer.width() / backbuffer.width()
+        scaleY = self.frontbuffer.height() / backbuffer.height()
+
+        def toFront(area: QRect) -> QRect:
+            return QRectF(
+                area.x() * scaleX, area.y() * scaleY,
+                area.width() * scaleX, area.height() * scaleY
+            ).toAlignedRect()
+
+        margin = self.RESCALE_MARGIN
+        source = rect.adjusted(-margin, -margin, margin, margin).intersected(backbuffer.rect())
+        target = toFront(source)
+
+        scaled = backbuffer.copy(source).scaled(
+            target.size(),
+            Qt.AspectRatioMode.IgnoreAspectRatio,
+            transformation
+        )
+
+        # the margin is only there for filtering, the pixels
+        # around the changed area are already up to date
+        changed = toFront(rect)
+        painter.setClipRect(changed)
+        painter.drawImage(target.topLeft(), scaled)
+        return changed
+
+    def _prepareBenchmark(self) -> bool:
+        # stands in for the backing store of the window
+        self._benchmarkTarget = QImage(self.size(), QImage.Format.Format_RGB32)
+        return True
+
+    def _renderBenchmarkFrame(self):
+        self.render(self._benchmarkTarget)
+
+class PixmapBackend(RasterBackend):
+    """
+    like RasterBackend, but paints from a QPixmap which is kept up to date
+    with the changed parts. On X11 pixmaps can live on the server side,
+    which makes repainting them cheaper.
+    """
+    name = "pixmap"
+
+    def __init__(self, parent: QWidget, scaling = SCALING_ADAPTIVE, smoothDelay = 300):
+        super().__init__(parent, scaling, smoothDelay)
+        self._pixmap: QPixmap = None
+
+    def setScaling(self, scaling: int):
+        self._pixmap = None
+        super().setScaling(scaling)
+
+    def _paintFrame(self, painter: QPainter, dirty: list):
+        if self.scaling == SCALING_NONE:
+            source = self.backbuffer
+            changed = [QRect(*rect) for rect in dirty]
+        else:
+            changed = self._updateFrontbuffer(dirty)
+            source = self.frontbuffer
+
+        if self._pixmap is None or self._pixmap.size() != source.size():
+            self._pixmap = QPixmap.fromImage(source)
+        elif changed:
+            pixmapPainter = QPainter(self._pixmap)
+            for rect in changed:
+                pixmapPainter.drawImage(rect, source, rect)
+            pixmapPainter.end()
+
+        painter.drawPixmap(0, 0, self._pixmap)
+
+class OpenGLBackend(QOpenGLWidget, RenderBackend):
+    """
+    Keeps the remote framebuffer in a single OpenGL texture, only the
+    changed rectangles are uploaded and scaling is done by the GPU.
+    Needs OpenGL 2.0, which Mesa's llvmpipe software renderer provides.
+    """
+    name = "opengl"
+
+    # 32 bit frame formats and how their bytes are uploaded
+    UPLOAD_FORMATS = {
+        QImage.Format.Format_RGB32: QOpenGLTexture.PixelFormat.BGRA,
+        QImage.Format.Format_RGBX8888: QOpenGLTexture.PixelFormat.RGBA,
+    }
+
+    VERTEX_SHADER = """
+        attribute vec2 position;
+        attribute vec2 texCoord;
+        varying vec2 fragCoord;
+        void main() {
+            fragCoord = texCoord;
+            gl_Position = vec4(position, 0.0, 1.0);
+        }
+    """
+    FRAGMENT_SHADER = """
+        #ifdef GL_ES
+        precision mediump float;
+        #endif
+        uniform sampler2D frame;
+        varying vec2 fragCoord;
+        void main() {
+            gl_FragColor = vec4(texture2D(frame, fragCoord).rgb, 1.0);
+        }
+    """
+
+    def __init__(self, parent: QWidget, scaling = SCALING_ADAPTIVE, smoothDelay = 300):
+        super().__init__(parent)
+        self._initBackend(scaling)
+
+        # GL state, created in initializeGL()
+        self.gl = None
+        self._program: QOpenGLShaderProgram = None
+        self._texture: QOpenGLTexture = None
+        self._textureSource: RFBTripleBuffer = None
+        self._pbo: QOpenGLBuffer = None
+        self._uploadFormat = QOpenGLTexture.PixelFormat.BGRA
+
+    @classmethod
+    def supportsFormat(cls, imageFormat: QImage.Format) -> bool:
+        # Format_RGB32 is only BGRA in memory on little endian machines
+        if imageFormat == QImage.Format.Format_RGB32:
+            return not HOST_BIGENDIAN
+        return imageFormat in cls.UPLOAD_FORMATS
+
+    def setFrames(self, tripleBuffer: RFBTripleBuffer, imageFormat: QImage.Format):
+        self._uploadFormat = self.UPLOAD_FORMATS[imageFormat]
+        super().setFrames(tripleBuffer, imageFormat)
+
+    def setScaling(self, scaling: int):
+        # filters are set when the texture gets created
+        self._textureSource = None
+        super().setScaling(scaling)
+
+    def initializeGL(self):
+        profile = QOpenGLVersionProfile()
+        profile.setVersion(2, 0)
+        self.gl = self.context().versionFunctions(profile)
+        if self.gl is None:
+            log.error("OpenGL 2.0 is not available")
+            return
+        self.gl.initializeOpenGLFunctions()
+
+        self._program = QOpenGLShaderProgram(self)
+        self._program.addShaderFromSourceCode(QOpenGLShader.Vertex, self.VERTEX_SHADER)
+        self._program.addShaderFromSourceCode(QOpenGLShader.Fragment, self.FRAGMENT_SHADER)
+        if not self._program.link():
+            log.error(f"Linking shaders failed: {self._program.log()}")
+
+        # pixel buffer objects are core since OpenGL 2.1
+        version = self.context().format().version()
+        if version >= (2, 1) or self.context().hasExtension(b"GL_ARB_pixel_buffer_object"):
+            self._pbo = QOpenGLBuffer(QOpenGLBuffer.Type.PixelUnpackBuffer)
+            self._pbo.setUsagePattern(QOpenGLBuffer.UsagePattern.StreamDraw)
+            if not self._pbo.create():
+                self._pbo = None
+        log.debug(f"OpenGL {version[0]}.{version[1]}, PBO: {self._pbo is not None}")
+
+        self.context().aboutToBeDestroyed.connect(self._destroyGL)
+
+    def _destroyGL(self):
+        self.makeCurrent()
+        if self._texture:
+            self._texture.destroy()
+        if self._pbo:
+            self._pbo.destroy()
+        self._texture = self._textureSource = self._pbo = None
+        self.doneCurrent()
+
+    def _createTexture(self, width: int, height: int):
+        if self._texture:
+            self._texture.destroy()
+
+        # nearest is enough when not scaling at all
+        if self.scaling in (SCALING_FAST, SCALING_NONE):
+            textureFilter = QOpenGLTexture.Filter.Nearest
+        else:
+            textureFilter = QOpenGLTexture.Filter.Linear
+
+        self._texture = QOpenGLTexture(QOpenGLTexture.Target.Target2D)
+        self._texture.setSize(width, height)
+        self._texture.setFormat(QOpenGLTexture.TextureFormat.RGBA8_UNorm)
+        self._texture.setMinMagFilters(textureFilter, textureFilter)
+        self._texture.setWrapMode(QOpenGLTexture.WrapMode.ClampToEdge)
+        self._texture.allocateStorage(
+            self._uploadFormat, QOpenGLTexture.PixelType.UInt8)
+
+    def _uploadRects(self, buffer: RFBFramebuffer, rects: list):
+        """
+        copies the rectangles from buffer into the texture, rows are
+        read straight from the framebuffer layout using UNPACK_ROW_LENGTH
+        """
+        options = QOpenGLPixelTransferOptions()
+        options.setRowLength(buffer.width)
+        options.setAlignment(1)
+
+        if not TEXTURE_SUBIMAGE:
+            rects = [(0, 0, buffer.width, buffer.height)]
+
+        def upload(x, y, w, h, data):
+            if TEXTURE_SUBIMAGE:
+                self._texture.setData(
+                    x, y, 0, w, h, 1,
+                    self._uploadFormat, QOpenGLTexture.PixelType.UInt8,
+                    data, options)
+            else:
+                self._texture.setData(
+                    self._uploadFormat, QOpenGLTexture.PixelType.UInt8,
+                    data, options)
+
+        if self._pbo is None:
+            for x, y, w, h in rects:
+                upload(x, y, w, h, buffer.view[buffer.offset(x, y):])
+            return
+
+        # the PBO mirrors the framebuffer layout, the rows of every
+        # rectangle are written to it and the driver copies them to the
+        # texture asynchronously. allocate() orphans the previous storage
+        # so this never waits for the last upload to finish.
+        self._pbo.bind()
+        self._pbo.allocate(buffer.stride * buffer.height)
+        for x, y, w, h in rects:
+            start, end = buffer.offset(0, y), buffer.offset(0, y + h)
+            self._pbo.write(start, buffer.view[start:end], end - start)
+            upload(x, y, w, h, sip.voidptr(buffer.offset(x, y)))
+        self._pbo.release()
+
+    def paintGL(self):
+        gl = self.gl
+        if gl is None:
+            return
+
+        ratio = self.devicePixelRatioF()
+        gl.glClearColor(0, 0, 0, 1)
+        gl.glClear(GL_COLOR_BUFFER_BIT)
+
+        tripleBuffer = self._tripleBuffer
+        if tripleBuffer is None:
+            return
+
+        index, dirty = tripleBuffer.acquire()
+        buffer = tripleBuffer.buffers[index]
+
+        if self._textureSource is not tripleBuffer:
+            # new connection, resized desktop or other filters
+            self._createTexture(buffer.width, buffer.height)
+            self._textureSource = tripleBuffer
+            dirty = [(0, 0, buffer.width, buffer.height)]
+        if dirty:
+            self._uploadRects(buffer, dirty)
+
+        # drawn at the top left like the other backends
+        size = QSize(buffer.width, buffer.height)
+        if self.scaling != SCALING_NONE:
+            size.scale(self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+        gl.glViewport(
+            0, int((self.height() - size.height()) * ratio),
+            int(size.width() * ratio), int(size.height() * ratio))
+
+        self._program.bind()
+        self._texture.bind(0)
+        self._program.setUniformValue("frame", 0)
+        self._program.enableAttributeArray("position")
+        self._program.enableAttributeArray("texCoord")
+        self._program.setAttributeArray("position", [
+            QVector2D(-1, -1), QVector2D(1, -1), QVector2D(-1, 1), QVector2D(1, 1)])
+        # first texture row is the top of the remote screen
+        self._program.setAttributeArray("texCoord", [
+            QVector2D(0, 1), QVector2D(1, 1), QVector2D(0, 0), QVector2D(1, 0)])
+
+        gl.glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+
+        self._program.disableAttributeArray("position")
+        self._program.disableAttributeArray("texCoord")
+        self._texture.release()
+        self._program.release()
+
+    def _prepareBenchmark(self) -> bool:
+        # creates the context even though the widget is not shown
+        if self.grabFramebuffer().isNull() or self.gl is None:
+            return False
+        return self._program.isLinked()
+
+    def _renderBenchmarkFrame(self):
+        self.makeCurrent()
+        self.paintGL()
+        self.gl.glFinish()
+        self.doneCurrent()
+
+# in order of preference when benchmarks are equally fast
+BACKENDS = {
+    backend.name: backend for backend in (RasterBackend, OpenGLBackend, PixmapBackend)
+}
+
+_fastestBackend: str = None
+
+def fastestBackend() -> str:
+    """
+    benchmarks all backends once and returns the name of the fastest one
+    """
+    global _fastestBackend
+    if _fastestBackend:
+        return _fastestBackend
+
+    results = dict()
+    for name, backend in BACKENDS.items():
+        result = backend.benchmark()
+        if result is not None:
+            results[name] = result
+    log.debug("Backend benchmark: " + ", ".join(
+        f"{name} {result*1e3:.2f} ms" for name, result in results.items()))
+
+    _fastestBackend = min(results, key=results.get, default=RasterBackend.name)
+    log.info(f"Using {_fastestBackend} backend")
+    return _fastestBackend
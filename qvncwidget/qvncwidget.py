@@ -6,59 +6,169 @@ licensed under GPLv3
 """
 
 import logging
-import time
 
 from PyQt5.QtCore import (
+    QRect,
+    QRectF,
     QSize,
+    QTimer,
     Qt,
-    pyqtSignal,
-    QSemaphore
+    pyqtSignal
 )
 from PyQt5.QtGui import (
+    QCursor,
     QImage,
-    QPaintEvent,
     QPainter,
-    QColor,
-    QBrush,
     QPixmap,
+    QRegion,
+    QHideEvent,
+    QMoveEvent,
     QResizeEvent,
+    QShowEvent,
     QKeyEvent,
     QMouseEvent
 )
 
 from PyQt5.QtWidgets import (
-    QWidget,
-    QLabel,
-    QWidget,
-    QOpenGLWidget
+    QApplication,
+    QVBoxLayout,
+    QWidget
 )
 
-from qvncwidget.rfb import RFBClient
-from qvncwidget.rfbhelpers import RFBPixelformat, RFBInput
+from qvncwidget import qvncbackends
+from qvncwidget.qvncbackends import RenderBackend
+from qvncwidget.rfb import RFBClient, CursorDecoder
+from qvncwidget.rfbhelpers import (
+    RFBFramebuffer,
+    RFBInput,
+    RFBPixelConverter,
+    RFBPixelformat,
+    RFBTripleBuffer
+)
 
 log = logging.getLogger("QVNCWidget")
 
 class QVNCWidget(QWidget, RFBClient):
 
     onInitialResize = pyqtSignal(QSize)
+    onDesktopResized = pyqtSignal(QSize)
+    onUpdateCursor = pyqtSignal(QImage, int, int)
+    onFrameReady = pyqtSignal()
+
+    # scaling modes, see qvncbackends
+    SCALING_ADAPTIVE = qvncbackends.SCALING_ADAPTIVE
+    SCALING_SMOOTH   = qvncbackends.SCALING_SMOOTH
+    SCALING_FAST     = qvncbackends.SCALING_FAST
+    SCALING_NONE     = qvncbackends.SCALING_NONE
+
+    # render backends, see qvncbackends.BACKENDS
+    BACKEND_AUTO   = "auto" # fastest one according to a benchmark
+    BACKEND_RASTER = qvncbackends.RasterBackend.name
+    BACKEND_PIXMAP = qvncbackends.PixmapBackend.name
+    BACKEND_OPENGL = qvncbackends.OpenGLBackend.name
+
+    # maxFps of the refresh rate of the screen the widget is on
+    FPS_DISPLAY = 0
 
     def __init__(self, parent: QWidget,
                  host: str, port = 5900, password: str = None,
-                 readOnly = False):
+                 readOnly = False,
+                 scaling = SCALING_ADAPTIVE,
+                 smoothDelay = 300,
+                 backend = BACKEND_AUTO,
+                 pixelFormat: RFBPixelformat = None,
+                 adaptiveEncoding = False,
+                 visibleUpdatesOnly = True,
+                 maxFps: float = None,
+                 pointerRate: float = 60):
+        """
+        smoothDelay is the idle time in ms after which
+        SCALING_ADAPTIVE does a smooth pass
+
+        backend selects how the remote screen gets painted,
+        BACKEND_AUTO benchmarks all of them once and takes the fastest
+
+        pixelFormat is requested from the server (RGB32 by default),
+        e.g. RFBPixelformat.getRGB16() halves the bandwidth of raw pixels.
+        Formats Qt can display directly are used as they are,
+        all others get converted to RGB32.
+
+        adaptiveEncoding adjusts encodings and pixel format to the
+        throughput of the connection, see RFBClient
+
+        visibleUpdatesOnly requests only the part of the remote screen
+        which is visible and pauses updates while the widget is hidden
+
+        maxFps caps how often updates are requested and repainted,
+        FPS_DISPLAY paces both to the refresh rate of the screen.
+        Updates arriving in between are painted together.
+
+        pointerRate caps how many pointer motions are sent per second,
+        only the latest position of each interval is sent. Button changes
+        always go out right away. None sends every motion.
+        """
         super().__init__(
             parent=parent,
-            host=host, port=port, password=password
+            host=host, port=port, password=password,
+            adaptiveEncoding=adaptiveEncoding
         )
         self.readOnly = readOnly
-
-        self.backbuffer: QImage = None
-        self.frontbuffer: QImage = None
+        self.visibleUpdatesOnly = visibleUpdatesOnly
+        self.preferredPixelFormat = pixelFormat or RFBPixelformat.getRGB32()
+
+        if backend == self.BACKEND_AUTO:
+            backend = qvncbackends.fastestBackend()
+        self.backend: RenderBackend = qvncbackends.BACKENDS[backend](
+            self, scaling, smoothDelay)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.backend)
+
+        # the RFB thread decodes into self.framebuffer and publishes
+        # finished updates into a triple buffer the backend paints from
+        self._tripleBuffer: RFBTripleBuffer = None
+        # set up for the negotiated pixel format in _createBackbuffer()
+        self.PIX_FORMAT: QImage.Format = None
+        self._converter: RFBPixelConverter = None
+        # area received in a new pixel format, None if not waiting for one
+        self._formatChangeRegion: QRegion = None
+
+        # rectangles changed by the current update
+        self._updateRects = list()
+        self.onFrameReady.connect(self._scheduleRepaint)
+
+        # at most one repaint per frame interval, see setMaxFps()
+        self._repaintTimer = QTimer(self)
+        self._repaintTimer.setSingleShot(True)
+        self._repaintTimer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._repaintTimer.timeout.connect(self._repaintDue)
+        self._repaintPending = False
+        self.setMaxFps(maxFps)
+
+        # cursor shape sent by the server, drawn locally by Qt
+        self.registerDecoder(CursorDecoder())
+        self.cursorImage: QImage = None
+        self.cursorHotspot = (0, 0)
+        self.onUpdateCursor.connect(self._setRemoteCursor)
+        self.onDesktopResized.connect(self._applyRemoteCursor)
+
+        self.onInitialResize.connect(self.updateViewport)
+        self.onDesktopResized.connect(self.updateViewport)
 
         self.setMouseTracking(not self.readOnly)
         self.setMinimumSize(1, 1) # make window scalable
 
         self.mouseButtonMask = 0
 
+        # motion waiting for the next pointer interval
+        self._pendingPointer: tuple = None
+        self._pointerTimer = QTimer(self)
+        self._pointerTimer.setSingleShot(True)
+        self._pointerTimer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._pointerTimer.timeout.connect(self._pointerDue)
+        self.setPointerRate(pointerRate)
+
     def start(self):
         self.startConnection()
 
@@ -68,625 +178,304 @@ class QVNCWidget(QWidget, RFBClient):
     def onConnectionMade(self):
         log.info("VNC handshake done")
 
-        self.setPixelFormat(RFBPixelformat.getRGB32())
-        self.PIX_FORMAT = QImage.Format.Format_RGB32
-
-        #self.setPixelFormat(RFBPixelformat.getRGB24())
-        #self.PIX_FORMAT = QImage.Format.Format_RGB888
-
-        #self.setPixelFormat(RFBPixelformat.getRGB16())
-        #self.PIX_FORMAT = QImage.Format.Format_RGB16
-
-        self.backbuffer = QImage(self.vncWidth, self.vncHeight, self.PIX_FORMAT)
+        self.setPixelFormat(self.preferredPixelFormat)
+        self._negotiateFormat()
+        self._createBackbuffer()
         self.onInitialResize.emit(QSize(self.vncWidth, self.vncHeight))
 
-    def onRectangleUpdate(self,
-            x: int, y: int, width: int, height: int, data: bytes):
+    def onDesktopResize(self, width: int, height: int):
+        self._createBackbuffer()
+        # whatever still fits has to be published as well
+        self._updateRects.append((0, 0, width, height))
+        self.onDesktopResized.emit(QSize(width, height))
+
+    def onPixelFormatChanged(self):
+        self._negotiateFormat()
+        # the last frame stays visible until the whole
+        # screen has been received in the new format
+        self._formatChangeRegion = QRegion()
 
-        if self.backbuffer is None:
-            log.warning("backbuffer is None")
+    def onColorMapChanged(self, first: int, count: int):
+        if self.pixformat.truecolor or self._tripleBuffer is None:
             return
+        self._negotiateFormat()
+        if self._formatChangeRegion is None:
+            # frames are converted when published, so all of them
+            # have to be converted again with the new colours
+            self._tripleBuffer.converter = self._converter
+            fb = self.framebuffer
+            self._tripleBuffer.publish(fb, [(0, 0, fb.width, fb.height)])
+            self.onFrameReady.emit()
+
+    def _negotiateFormat(self):
+        # display the pixels as they are if Qt and the backend can,
+        # otherwise they get converted while being published
+        imageFormat = self.pixformat.qimageFormat()
+        if imageFormat is None or not self.backend.supportsFormat(imageFormat):
+            self._converter = RFBPixelConverter(self.pixformat, self.colorMap)
+            imageFormat = QImage.Format.Format_RGB32
         else:
-            log.debug("drawing backbuffer")
-
-        #with open(f"{width}x{height}.data", "wb") as f:
-        #    f.write(data)
-
-        t1 = time.time()
-
-        painter = QPainter(self.backbuffer)
-        painter.drawImage(x, y, QImage(data, width, height, self.PIX_FORMAT))
-        painter.end()
-
-        log.debug(f"painting took: {(time.time() - t1)*1e3} ms")
-
-        del painter
-        del data
+            self._converter = None
+        log.debug(f"Pixel format {self.pixformat} displayed as {imageFormat}, "
+                  f"converted: {self._converter is not None}")
+
+        self.PIX_FORMAT = imageFormat
+
+    def _createBackbuffer(self):
+        fb = self.framebuffer
+        bytespp = 4 if self._converter else fb.bytespp
+
+        self._formatChangeRegion = None
+        self._tripleBuffer = RFBTripleBuffer(
+            fb.width, fb.height, bytespp, self._converter)
+        self.backend.setFrames(self._tripleBuffer, self.PIX_FORMAT)
+
+    def _toImage(self, pixels: bytes, width: int, height: int) -> QImage:
+        """
+        QImage of pixels in the negotiated pixel format
+        """
+        bytespp = self.pixformat.bytespp
+        if self._converter is not None:
+            source = RFBFramebuffer(width, height, bytespp)
+            source.putRect(0, 0, width, height, pixels)
+            target = RFBFramebuffer(width, height, 4)
+            self._converter(source, target, 0, 0, width, height)
+            pixels, bytespp = target.data, 4
+
+        image = QImage(pixels, width, height, width * bytespp, self.PIX_FORMAT)
+        # detached from pixels, which may be gone soon
+        return image.copy()
+
+    def onBeginUpdate(self):
+        self._updateRects = list()
+
+    def onFramebufferChanged(self,
+            x: int, y: int, width: int, height: int):
+        self._updateRects.append((x, y, width, height))
 
     def onFramebufferUpdateFinished(self):
         log.debug("FB Update finished")
-        self.update()
+        rects, self._updateRects = self._updateRects, list()
+        if not rects:
+            return
 
-    def paintEvent(self, a0: QPaintEvent):
-        #log.debug("Paint event")
-        painter = QPainter(self)
+        if self._formatChangeRegion is not None:
+            # rectangles may overlap, and only the requested
+            # part of the screen is sent again
+            for rect in rects:
+                self._formatChangeRegion += QRect(*rect)
+            if not QRegion(QRect(*self._updateRect())).subtracted(
+                    self._formatChangeRegion).isEmpty():
+                return
+            fb = self.framebuffer
+            self._createBackbuffer()
+            rects = [(0, 0, fb.width, fb.height)]
+
+        self._tripleBuffer.publish(self.framebuffer, rects)
+        # queued, the backend paints in the GUI thread
+        self.onFrameReady.emit()
+
+    def onCursorUpdate(self,
+            hotX: int, hotY: int, width: int, height: int,
+            pixels: bytes, mask: bytes):
+        if not width or not height:
+            self.onUpdateCursor.emit(QImage(), 0, 0)
+            return
 
-        if self.backbuffer is None:
-            log.debug("backbuffer is None")
-            painter.fillRect(0, 0, self.width(), self.height(), Qt.GlobalColor.black)
+        # called from the RFB thread, QPixmap and QCursor can only be
+        # created in the GUI thread so the shape is handed over as QImage
+        cursor = self._toImage(pixels, width, height).convertToFormat(
+            QImage.Format.Format_ARGB32_Premultiplied)
 
-        else:
-            self.frontbuffer = self.backbuffer.scaled(
-                    self.width(), self.height(),
-                    Qt.AspectRatioMode.KeepAspectRatio,
-                    Qt.TransformationMode.SmoothTransformation
-                )
-            painter.drawImage(0, 0, self.frontbuffer)
+        alpha = QImage(mask, width, height, (width + 7) // 8, QImage.Format.Format_Mono)
+        alpha.setColorTable([0x00000000, 0xffffffff])
 
+        painter = QPainter(cursor)
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_DestinationIn)
+        painter.drawImage(0, 0, alpha)
         painter.end()
 
-    # Mouse events
-
-    def mousePressEvent(self, ev: QMouseEvent):
-        if self.readOnly or not self.frontbuffer: return
-        self.mouseButtonMask = RFBInput.fromQMouseEvent(ev, True, self.mouseButtonMask)
-        self.pointerEvent(*self._getRemoteRel(ev), self.mouseButtonMask)
-
-    def mouseReleaseEvent(self, ev: QMouseEvent):
-        if self.readOnly or not self.frontbuffer: return
-        self.mouseButtonMask = RFBInput.fromQMouseEvent(ev, False, self.mouseButtonMask)
-        self.pointerEvent(*self._getRemoteRel(ev), self.mouseButtonMask)
-
-    def mouseMoveEvent(self, ev: QMouseEvent):
-        if self.readOnly or not self.frontbuffer: return
-        self.pointerEvent(*self._getRemoteRel(ev), self.mouseButtonMask)
-
-    def _getRemoteRel(self, ev: QMouseEvent) -> tuple:
-        xPos = (ev.localPos().x() / self.frontbuffer.width()) * self.vncWidth
-        yPos = (ev.localPos().y() / self.frontbuffer.height()) * self.vncHeight
-
-        return int(xPos), int(yPos)
-
-    # Key events
+        self.onUpdateCursor.emit(cursor, hotX, hotY)
 
-    def keyPressEvent(self, ev: QKeyEvent):
-        if self.readOnly: return
-        self.keyEvent(RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=1)
+    def _setRemoteCursor(self, cursor: QImage, hotX: int, hotY: int):
+        self.cursorImage = cursor
+        self.cursorHotspot = (hotX, hotY)
+        self._applyRemoteCursor()
 
-    def keyReleaseEvent(self, ev: QKeyEvent):
-        if self.readOnly: return
-        self.keyEvent(RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=0)
-
-
-# other experimental implementations
-
-class QVNCWidgetGL(QOpenGLWidget, RFBClient):
-
-    IMG_FORMAT = QImage.Format_RGB32
-
-    onInitialResize = pyqtSignal(QSize)
-    #onUpdatePixmap = pyqtSignal(int, int, int, int, bytes)
-    onUpdatePixmap = pyqtSignal()
-    onSetPixmap = pyqtSignal()
-
-    onKeyPress = pyqtSignal(QKeyEvent)
-    onKeyRelease = pyqtSignal(QKeyEvent)
-
-    def __init__(self, parent, 
-            host, port=5900, password: str=None,
-            mouseTracking=False):
+    def _applyRemoteCursor(self):
+        if self.cursorImage is None:
+            return
+        if self.cursorImage.isNull():
+            self.setCursor(Qt.CursorShape.BlankCursor)
+            return
 
-        #super(QOpenGLWidget, self).__init__()
-        #super(RFBClient, self).__init__(
-        super().__init__(
-            parent=parent,
-            host=host,
-            port=port,
-            password=password,
-            daemonThread=True
+        # the cursor is scaled like the remote desktop
+        scale = self.backend.scale()
+        hotX, hotY = self.cursorHotspot
+        cursor = self.cursorImage.scaled(
+            max(1, round(self.cursorImage.width() * scale)),
+            max(1, round(self.cursorImage.height() * scale)),
+            Qt.AspectRatioMode.IgnoreAspectRatio,
+            Qt.TransformationMode.SmoothTransformation
         )
+        self.setCursor(QCursor(
+            QPixmap.fromImage(cursor), int(hotX * scale), int(hotY * scale)))
+
+    def setMaxFps(self, fps: float):
+        """
+        None removes the cap, FPS_DISPLAY follows the screen refresh rate
+        """
+        self._requestedFps = fps
+        if fps == self.FPS_DISPLAY:
+            fps = self._displayRefreshRate()
+
+        self.maxFps = fps
+        if fps:
+            self._repaintTimer.setInterval(max(1, round(1000 / fps)))
+        else:
+            self._repaintTimer.stop()
+
+    def _displayRefreshRate(self) -> float:
+        window = self.window().windowHandle()
+        screen = window.screen() if window else QApplication.primaryScreen()
+        if screen is None or screen.refreshRate() <= 0:
+            return 60.0
+        return screen.refreshRate()
+
+    def _scheduleRepaint(self):
+        if not self.maxFps:
+            self.backend.update()
+        elif self._repaintTimer.isActive():
+            # painted with the next frame
+            self._repaintPending = True
+        else:
+            # first one after a quiet period goes out right away
+            self.backend.update()
+            self._repaintTimer.start()
+
+    def _repaintDue(self):
+        if self._repaintPending:
+            self._repaintPending = False
+            self.backend.update()
+            self._repaintTimer.start()
+
+    @property
+    def scaling(self) -> int:
+        return self.backend.scaling
+
+    def setScalingMode(self, scaling: int):
+        self.backend.setScaling(scaling)
+        self._applyRemoteCursor()
+        self.updateViewport()
+
+    def updateViewport(self):
+        """
+        limits update requests to the visible part of the remote screen,
+        called on every change of the widget. Has to be called when the
+        visible part changes otherwise, e.g. when a parent gets scrolled.
+        """
+        if not self.visibleUpdatesOnly or self._tripleBuffer is None:
+            return
 
-        #self.setAlignment(Qt.AlignCenter)
-
-        #self.onUpdatePixmap.connect(self._updateImage)
-        #self.onSetPixmap.connect(self._setImage)
-        self.onSetPixmap.connect(self._updateImage)
-
-        self.acceptMouseEvents = False # mouse events are not accepted at first
-        self.setMouseTracking(mouseTracking)
-        
-        # Allow Resizing
-        self.setMinimumSize(1, 1)
-
-        self.data = list(tuple())
-        self.dataMonitor = QSemaphore(0)
-
-    def start(self):
-        self.startConnection()
-
-    def stop(self):
-        self.closeConnection()
-
-    def onConnectionMade(self):
-        log.info("VNC handshake done")
-
-        self.setPixelFormat(RFBPixelformat.getRGB32())
-        self.onInitialResize.emit(QSize(self.vncWidth, self.vncHeight))
-        self._initKeypress()
-        self._initMouse()
-
-    def onRectangleUpdate(self,
-            x: int, y: int, width: int, height: int, data: bytes):
-        #img = QImage(data, width, height, self.IMG_FORMAT)
-        #self.onUpdatePixmap.emit(x, y, width, height, data)
-
-        #self.dataMonitor.acquire(1)
-
-        self.data.append((x, y, width, height, data))
-        #self.data = (x, y, width, height, data)
-        #self.dataMonitor.release(1)
-
-        #self.onUpdatePixmap.emit()
-        
-        #else:
-        #    print("AAAAAAAAAAAAAA", "MONITOR AQUIRE FAILED")
-
-    def onFramebufferUpdateFinished(self):
-        self.onSetPixmap.emit()
-        return
-
-        if self.pixmap:
-            #self.setPixmap(QPixmap.fromImage(self.image))
-            self.resizeEvent(None)
-
-    def onFatalError(self, error: Exception):
-        log.error(str(error))
-        #logging.exception(str(error))
-        #self.reconnect()
-
-    #def _updateImage(self, x: int, y: int, width: int, height: int, data: bytes):
-    def _updateImage(self):
-        print("update image")
-        self.update()
-
-        #if not self.screen:
-        #    self.screen = QImage(width, height, self.IMG_FORMAT)
-        #    self.screen.fill(Qt.red)
-        #    self.screenPainter = QPainter(self.screen)
-
-        #self.painter.beginNativePainting()
-        #self.painter.drawPixmapFragments()
-
-        #with open("/tmp/images/test.raw", "wb") as f:
-        #    f.write(data)
-        
-        #p = QPainter(self.screen)
-
-        #self.screenPainter.drawImage(
-        #    x, y, QImage(data, width, height, self.IMG_FORMAT))
-
-        #p.end()
-
-        #self.repaint()
-        #self.update()
-
-    def _setPixmap(self):
-        if self.pixmap:
-            self.setPixmap(
-                self.pixmap.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-            )
-
-    def _setImage(self):
-        if self.screen:
-            self.setPixmap(QPixmap.fromImage(
-                self.screen.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-            ))
-        self.acceptMouseEvents = True  # mouse events are getting accepted
-
-    # Passed events
-
-    def _keyPress(self, ev: QKeyEvent):
-        self.keyEvent(
-            RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=1)
-
-    def _keyRelease(self, ev: QKeyEvent):
-        self.keyEvent(
-            RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=0)
-
-    # Window events
-
-    def paintEvent(self, e: QPaintEvent):
-        print("paint event")
-
-        #self.dataMonitor.acquire(1)
-
-        #while self.dataMonitor.tryAcquire(1):
-        while len(self.data) > 0:
-            x, y, w, h, data = self.data.pop(0)
-
-            p = QPainter(self)
-
-        #p.setPen(QColor(255, 0, 0))
-        #p.drawText(e.rect(), Qt.AlignCenter, str(self.dataMonitor.available()))
-        
-            p.drawImage(x, y, QImage(data, w, h, self.IMG_FORMAT))
-            p.end()
+        # the backend covers the whole widget, its visible region is
+        # clipped by parents and covered by siblings like ours
+        visible = QRect()
+        if self.isVisible():
+            visible = self.backend.visibleRegion().boundingRect()
 
-        #self.dataMonitor.release(1)
+        scale = self.backend.scale()
+        remote = QRectF(
+            visible.x() / scale, visible.y() / scale,
+            visible.width() / scale, visible.height() / scale
+        ).toAlignedRect().intersected(QRect(0, 0, self.vncWidth, self.vncHeight))
 
-        return
+        if remote.isEmpty():
+            self.pauseUpdates()
+            return
 
-        p = QPainter(self)
-        p.fillRect(e.rect(), QBrush(QColor(255, 255, 255)))
-        p.end()
+        self.setUpdateRegion(remote.x(), remote.y(), remote.width(), remote.height())
+        self.resumeUpdates()
 
-        return
+    def resizeEvent(self, a0: QResizeEvent):
+        self._applyRemoteCursor()
+        super().resizeEvent(a0)
+        self.updateViewport()
 
-        if self.dataMonitor.tryAcquire(1):
-            x, y, w, h, data = self.data
+    def moveEvent(self, a0: QMoveEvent):
+        super().moveEvent(a0)
+        self.updateViewport()
 
-            p = QPainter(self)
-            p.drawImage(x, y, QImage(data, w, h, self.IMG_FORMAT))
-            p.end()
+    def showEvent(self, a0: QShowEvent):
+        super().showEvent(a0)
+        if self._requestedFps == self.FPS_DISPLAY:
+            # might be on another screen now
+            self.setMaxFps(self.FPS_DISPLAY)
+        self.updateViewport()
 
-            self.dataMonitor.release(1)
+    def hideEvent(self, a0: QHideEvent):
+        super().hideEvent(a0)
+        self.updateViewport()
 
-            print("CCCCC", "Image painted diggah")
+    # Mouse events
 
+    def setPointerRate(self, rate: float):
+        self.pointerRate = rate
+        if rate:
+            self._pointerTimer.setInterval(max(1, round(1000 / rate)))
         else:
-            print("BBBBBBBBB", "aquire monitor failed")
-
-        #return super().paintEvent(a0)
-        return
-
-        if not self.screen:
-            self.screen = QImage(self.size(), self.IMG_FORMAT)
-            self.screen.fill(Qt.red)
-            self.screenPainter = QPainter(self.screen)
-
-        p = QPainter()
-        p.begin(self)
-        p.drawImage(0, 0,
-            self.screen.scaled(
-                self.width(), self.height(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation
-            ))
-        p.end()
-
-    def resizeEvent(self, e: QResizeEvent):
-        return super().resizeEvent(e)
-
-    def resizeGL(self, w: int, h: int):
-        print("RESIZE THAT BITCH!!!", w, h)
-        #return super().resizeGL(w, h)
-
-    def resizeEvent_(self, a0: QResizeEvent):
-        #print("RESIZE!", self.width(), self.height())
-        #return super().resizeEvent(a0)
-        if self.screen:
-            self.setPixmap(QPixmap.fromImage(
-                self.screen.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                ))
-            )
-        return super().resizeEvent(a0)
+            self._pointerTimer.stop()
+            self._pointerDue()
 
     def mousePressEvent(self, ev: QMouseEvent):
-        #print(ev.localPos(), ev.button())
-        #print(self.height() - self.pixmap().height())
-
-        if self.acceptMouseEvents: # need pixmap instance
-            self.buttonMask = RFBInput.fromQMouseEvent(ev, True, self.buttonMask)
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
-
-        return super().mousePressEvent(ev)
+        if self.readOnly or self._tripleBuffer is None: return
+        self.mouseButtonMask = RFBInput.fromQMouseEvent(ev, True, self.mouseButtonMask)
+        self._sendButtons(ev)
 
     def mouseReleaseEvent(self, ev: QMouseEvent):
-        if self.acceptMouseEvents: # need pixmap instance
-            self.buttonMask = RFBInput.fromQMouseEvent(ev, False, self.buttonMask)
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
-
-        return super().mouseReleaseEvent(ev)
+        if self.readOnly or self._tripleBuffer is None: return
+        self.mouseButtonMask = RFBInput.fromQMouseEvent(ev, False, self.mouseButtonMask)
+        self._sendButtons(ev)
 
     def mouseMoveEvent(self, ev: QMouseEvent):
-        if self.acceptMouseEvents: # need pixmap instance
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
-
-    # FIXME: The pixmap is assumed to be aligned center.
-    def _getRemoteRel(self, ev: QMouseEvent) -> tuple:
-        # FIXME: this code is ugly as fk
-
-        # y coord is kinda fucked up
-        yDiff = (self.height() - self.pixmap().height()) / 2
-        yPos = ev.localPos().y() - yDiff
-        if yPos < 0: yPos = 0
-        if yPos > self.pixmap().height(): yPos = self.pixmap().height()
-
-        yPos = self._calcRemoteRel(
-            yPos, self.pixmap().height(), self.vncHeight)
-
-        # x coord is kinda fucked up, too
-        xDiff = (self.width() - self.pixmap().width()) / 2
-        xPos = ev.localPos().x() - xDiff
-        if xPos < 0: xPos = 0
-        if xPos > self.pixmap().width(): xPos = self.pixmap().width()
-
-        xPos = self._calcRemoteRel(
-            xPos, self.pixmap().width(), self.vncWidth)
-        
-        return xPos, yPos
-
-    def _calcRemoteRel(self, locRel, locMax, remoteMax) -> int:
-        return int( (locRel / locMax) * remoteMax )
-
-    def _initMouse(self):
-        self.buttonMask = 0 # pressed buttons (bit fields)
-
-    def _initKeypress(self):
-        self.onKeyPress.connect(self._keyPress)
-        self.onKeyRelease.connect(self._keyRelease)
-
-    def __del__(self):
-        self.stop()
-    
-    def __exit__(self, *args):
-        self.stop()
-        self.deleteLater()
-
-class QVNCWidget_old(QLabel, RFBClient):
-    
-    IMG_FORMAT = QImage.Format_RGB32
-
-    onInitialResize = pyqtSignal(QSize)
-    onUpdatePixmap = pyqtSignal(int, int, int, int, bytes)
-    onSetPixmap = pyqtSignal()
-
-    onKeyPress = pyqtSignal(QKeyEvent)
-    onKeyRelease = pyqtSignal(QKeyEvent)
-
-    def __init__(self, parent, 
-                host, port=5900, password: str=None,
-                mouseTracking=False):
-        super().__init__(
-            parent=parent,
-            host=host,
-            port=port,
-            password=password,
-            daemonThread=True
-        )
-        #import faulthandler
-        #faulthandler.enable()
-        self.screen: QImage = None
-
-        # FIXME: The pixmap is assumed to be aligned center.
-        self.setAlignment(Qt.AlignCenter)
-
-        self.onUpdatePixmap.connect(self._updateImage)
-        self.onSetPixmap.connect(self._setImage)
-
-        self.acceptMouseEvents = False # mouse events are not accepted at first
-        self.setMouseTracking(mouseTracking)
-        
-        # Allow Resizing
-        self.setMinimumSize(1,1)
-
-    def _initMouse(self):
-        self.buttonMask = 0 # pressed buttons (bit fields)
-
-    def _initKeypress(self):
-        self.onKeyPress.connect(self._keyPress)
-        self.onKeyRelease.connect(self._keyRelease)
-
-    def start(self):
-        self.startConnection()
-
-    def stop(self):
-        self.closeConnection()
-        if self.screenPainter: self.screenPainter.end()
-
-    def onConnectionMade(self):
-        self.onInitialResize.emit(QSize(self.vncWidth, self.vncHeight))
-        self.setPixelFormat(RFBPixelformat.getRGB32())
-        self._initKeypress()
-        self._initMouse()
-
-    def onRectangleUpdate(self,
-            x: int, y: int, width: int, height: int, data: bytes):
-        #img = QImage(data, width, height, self.IMG_FORMAT)
-        self.onUpdatePixmap.emit(x, y, width, height, data)
-
-    def onFramebufferUpdateFinished(self):
-        self.onSetPixmap.emit()
-        return
-
-        if self.pixmap:
-            #self.setPixmap(QPixmap.fromImage(self.image))
-            self.resizeEvent(None)
-
-    def onFatalError(self, error: Exception):
-        log.error(str(error))
-        #logging.exception(str(error))
-        #self.reconnect()
-
-    def _updateImage(self, x: int, y: int, width: int, height: int, data: bytes):
-        if not self.screen:
-            self.screen = QImage(width, height, self.IMG_FORMAT)
-            self.screen.fill(Qt.red)
-            self.screenPainter = QPainter(self.screen)
-
-        #self.painter.beginNativePainting()
-        #self.painter.drawPixmapFragments()
-
-        #with open("/tmp/images/test.raw", "wb") as f:
-        #    f.write(data)
-        
-        #p = QPainter(self.screen)
-        self.screenPainter.drawImage(
-            x, y, QImage(data, width, height, self.IMG_FORMAT))
-        #p.end()
-
-        #self.repaint()
-        #self.update()
-
-    def _drawPixmap(self, x: int, y: int, pix: QPixmap):
-        #self.paintLock.acquire()
-        self.pixmap = pix
-
-        if not self.painter:
-            self.painter = QPainter(self.pixmap)
+        if self.readOnly or self._tripleBuffer is None: return
+        position = self._getRemoteRel(ev)
+
+        if not self.pointerRate:
+            self.pointerEvent(*position, self.mouseButtonMask)
+        elif self._pointerTimer.isActive():
+            # replaces older motion of this interval
+            self._pendingPointer = position
         else:
-            print("DRAW PIXMAP:", x, y, self.pixmap, self.painter, pix, pix.isNull())
-            self.painter.drawPixmap(x, y, self.pixmap)
-        #self.paintLock.release()
+            # first motion after a pause goes out right away
+            self.pointerEvent(*position, self.mouseButtonMask)
+            self._pointerTimer.start()
 
-    def _drawPixmap2(self, x: int, y: int, pix: QPixmap, data: bytes):
-        if not self.pixmap or (
-            x == 0 and y == 0 and
-            pix.width() == self.pixmap.width() and pix.height() == self.pixmap.height()):
+    def _sendButtons(self, ev: QMouseEvent):
+        # pending motion is older than the click, which has its own position
+        self._pendingPointer = None
+        self.pointerEvent(*self._getRemoteRel(ev), self.mouseButtonMask)
 
-            self.pixmap = pix.copy()
-            self._setPixmap()
+    def _pointerDue(self):
+        if self._pendingPointer is None:
             return
-        
-        import time
-        print("DRAW PIXMAP:", x, y, self.pixmap.width(), self.pixmap.height(), pix.width(), pix.height())
-        _t = time.time()
-        #self.pixmap.save(f"/tmp/images/imgP_{_t}", "jpg")
-        #with open(f"/tmp/images/img_{_t}.raw", "wb") as f:
-        #    f.write(data)
-        #pix.save(f"/tmp/images/img_{_t}", "jpg")
-
-        painter = QPainter(self.pixmap)
-        painter.drawPixmap(x, y, pix)
-        painter.end()
-        #self._setPixmap()
-
-    def _setPixmap(self):
-        if self.pixmap:
-            self.setPixmap(
-                self.pixmap.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-            )
-
-    def _setImage(self):
-        if self.screen:
-            self.setPixmap(QPixmap.fromImage(
-                self.screen.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-            ))
-        self.acceptMouseEvents = True  # mouse events are getting accepted
-
-    # Passed events
-
-    def _keyPress(self, ev: QKeyEvent):
-        self.keyEvent(
-            RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=1)
-
-    def _keyRelease(self, ev: QKeyEvent):
-        self.keyEvent(
-            RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=0)
-
-    # Window events
-
-    def paintEvent(self, a0: QPaintEvent):
-        return super().paintEvent(a0)
-        if not self.screen:
-            self.screen = QImage(self.size(), self.IMG_FORMAT)
-            self.screen.fill(Qt.red)
-            self.screenPainter = QPainter(self.screen)
-
-        p = QPainter()
-        p.begin(self)
-        p.drawImage(0, 0,
-            self.screen.scaled(
-                self.width(), self.height(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation
-            ))
-        p.end()
-
-    def resizeEvent(self, a0: QResizeEvent):
-        #print("RESIZE!", self.width(), self.height())
-        #return super().resizeEvent(a0)
-        if self.screen:
-            self.setPixmap(QPixmap.fromImage(
-                self.screen.scaled(
-                    self.width(), self.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                ))
-            )
-        return super().resizeEvent(a0)
+        position, self._pendingPointer = self._pendingPointer, None
+        self.pointerEvent(*position, self.mouseButtonMask)
+        if self.pointerRate:
+            self._pointerTimer.start()
 
-    def mousePressEvent(self, ev: QMouseEvent):
-        #print(ev.localPos(), ev.button())
-        #print(self.height() - self.pixmap().height())
-
-        if self.acceptMouseEvents: # need pixmap instance
-            self.buttonMask = RFBInput.fromQMouseEvent(ev, True, self.buttonMask)
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
-
-        return super().mousePressEvent(ev)
+    def _getRemoteRel(self, ev: QMouseEvent) -> tuple:
+        scale = self.backend.scale()
+        xPos = min(int(ev.localPos().x() / scale), self.vncWidth - 1)
+        yPos = min(int(ev.localPos().y() / scale), self.vncHeight - 1)
 
-    def mouseReleaseEvent(self, ev: QMouseEvent):
-        if self.acceptMouseEvents: # need pixmap instance
-            self.buttonMask = RFBInput.fromQMouseEvent(ev, False, self.buttonMask)
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
+        return max(xPos, 0), max(yPos, 0)
 
-        return super().mouseReleaseEvent(ev)
+    # Key events
 
-    def mouseMoveEvent(self, ev: QMouseEvent):
-        if self.acceptMouseEvents: # need pixmap instance
-            self.pointerEvent(*self._getRemoteRel(ev), self.buttonMask)
+    def keyPressEvent(self, ev: QKeyEvent):
+        if self.readOnly: return
+        self.keyEvent(RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=1)
 
-    # FIXME: The pixmap is assumed to be aligned center.
-    def _getRemoteRel(self, ev: QMouseEvent) -> tuple:
-        # FIXME: this code is ugly as fk
-
-        # y coord is kinda fucked up
-        yDiff = (self.height() - self.pixmap().height()) / 2
-        yPos = ev.localPos().y() - yDiff
-        if yPos < 0: yPos = 0
-        if yPos > self.pixmap().height(): yPos = self.pixmap().height()
-
-        yPos = self._calcRemoteRel(
-            yPos, self.pixmap().height(), self.vncHeight)
-
-        # x coord is kinda fucked up, too
-        xDiff = (self.width() - self.pixmap().width()) / 2
-        xPos = ev.localPos().x() - xDiff
-        if xPos < 0: xPos = 0
-        if xPos > self.pixmap().width(): xPos = self.pixmap().width()
-
-        xPos = self._calcRemoteRel(
-            xPos, self.pixmap().width(), self.vncWidth)
-        
-        return xPos, yPos
-
-    def _calcRemoteRel(self, locRel, locMax, remoteMax) -> int:
-        return int( (locRel / locMax) * remoteMax )
-
-
-    def __del__(self):
-        self.stop()
-    
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
-        self.deleteLater()
+    def keyReleaseEvent(self, ev: QKeyEvent):
+        if self.readOnly: return
+        self.keyEvent(RFBInput.fromQKeyEvent(ev.key(), ev.text()), down=0)
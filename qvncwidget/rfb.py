@@ -9,17 +9,33 @@ References:
 - https://github.com/rfbproto/rfbproto/blob/master/rfbproto.rst
 """
 
-from qvncwidget.rfbhelpers import RFBPixelformat, RFBRectangle
+from qvncwidget.rfbhelpers import RFBPixelformat, RFBRectangle, RFBFramebuffer, RFBThroughput
 from qvncwidget.rfbdes import RFBDes
 import qvncwidget.rfbconstants as c
 import qvncwidget.easystruct as es
 
-from threading import Thread
+from PyQt5.QtGui import QImage
+
+from collections import namedtuple
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+import io
 import logging
+import os
+import select
+import sys
 import socket
 from socket import SHUT_RDWR
 import struct as s
 import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class RFBUnexpectedResponse(Exception):
     pass
@@ -50,11 +66,1003 @@ KNOWN_VERSIONS = [
 5.0: RealVNC 5.3
 """
 
-SUPPORTED_ENCODINGS = [
-    c.ENC_RAW
+MAX_BUFF_SIZE: int = 10*1024*1024 # 10MB
+RECV_BUFF_SIZE: int = 256*1024 # 256KB
+# with continuous updates, more unprocessed data than this makes
+# the client fall back to requesting updates one by one
+MAX_IN_FLIGHT: int = 8*1024*1024 # 8MB
+FLOW_CONTROL_FENCE = b"qvnc"
+# updates up to this fence are still in the previous pixel format
+PIXEL_FORMAT_FENCE = b"qvpf"
+
+# what adaptiveEncoding requests depending on the link throughput,
+# from slow to fast. A profile is used from minKbps on, lowColor
+# switches to 16 bit pixels, None leaves out the pseudo-encoding
+AdaptiveProfile = namedtuple("AdaptiveProfile",
+    "name minKbps encoding lowColor jpegQuality compressLevel")
+
+ADAPTIVE_PROFILES = [
+    AdaptiveProfile("slow",   0,     c.ENC_TIGHT, True,  None, 9),
+    AdaptiveProfile("medium", 1500,  c.ENC_TIGHT, False, 7,    6),
+    AdaptiveProfile("fast",   10000, c.ENC_ZRLE,  False, None, 1),
+    AdaptiveProfile("lan",    80000, c.ENC_RAW,   False, None, None),
 ]
+# hysteresis, switching to a faster profile needs this much more than
+# its minKbps, and every switch needs as many samples in a row
+# agreeing on it and some time passed since the last one
+ADAPT_UP_MARGIN = 1.5
+ADAPT_SAMPLES = 3
+ADAPT_INTERVAL = 5.0 # seconds
+
+# TCP keepalive, seconds of silence before probing, between probes
+# and number of unanswered probes until the connection is dropped
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+HEXTILE_TILE_SIZE = 16
+# shared by all connections of the process
+JPEG_WORKERS = min(4, os.cpu_count() or 1)
+
+# packed palette indices of 1, 2 and 4 bits, byte value -> one byte per index
+_UNPACK_TABLES = {
+    bits: [
+        bytes((byte >> (8 - bits*(i + 1))) & ((1 << bits) - 1)
+              for i in range(8 // bits))
+        for byte in range(256)
+    ]
+    for bits in (1, 2, 4)
+}
+_SINGLE_BYTES = [bytes((i,)) for i in range(256)]
+
+def _cpixelPadding(pixformat: RFBPixelformat):
+    """
+    returns the position of the byte which is not transmitted in a
+    compressed pixel (CPIXEL) or None if CPIXEL and PIXEL are the same
+    """
+    if not pixformat.truecolor or pixformat.bitspp != 32 or pixformat.depth > 24:
+        return None
+
+    colors = (
+        (pixformat.redmax, pixformat.redshift),
+        (pixformat.greenmax, pixformat.greenshift),
+        (pixformat.bluemax, pixformat.blueshift)
+    )
+
+    if all((cmax << shift) < (1 << 24) for cmax, shift in colors):
+        # fits into the least significant 3 bytes
+        return 0 if pixformat.bigendian else 3
+    if all(shift >= 8 for _, shift in colors):
+        # fits into the most significant 3 bytes
+        return 3 if pixformat.bigendian else 0
+
+    return None
+
+def _expandCPixels(data: bytes, padding: int, bytespp: int):
+    """
+    converts CPIXEL data to pixels in the framebuffer format,
+    returns a (n, bytespp) numpy array if numpy is available
+    """
+    if padding is None:
+        if np is not None:
+            return np.frombuffer(data, np.uint8).reshape(-1, bytespp)
+        return data
+
+    count = len(data) // 3
+    planes = [i for i in range(4) if i != padding]
+
+    if np is not None:
+        pixels = np.zeros((count, 4), np.uint8)
+        pixels[:, planes] = np.frombuffer(data, np.uint8).reshape(count, 3)
+        return pixels
+
+    pixels = bytearray(count * 4)
+    for i, plane in enumerate(planes):
+        pixels[plane::4] = data[i::3]
+    return pixels
+
+def _unpackIndices(data: bytes, bits: int, width: int, height: int):
+    """
+    unpacks palette indices with 1, 2 or 4 bits per pixel,
+    every row starts on a byte boundary
+    """
+    rowSize = (width*bits + 7) // 8
+
+    if np is not None:
+        packed = np.frombuffer(data, np.uint8).reshape(height, rowSize)
+        unpacked = np.unpackbits(packed, axis=1)
+        if bits > 1:
+            weights = 1 << np.arange(bits - 1, -1, -1, dtype=np.uint8)
+            unpacked = unpacked.reshape(height, -1, bits) @ weights
+        return unpacked[:, :width].astype(np.uint8).ravel()
+
+    table = _UNPACK_TABLES[bits]
+    return b"".join(
+        b"".join(map(table.__getitem__, data[row*rowSize:(row + 1)*rowSize]))[:width]
+        for row in range(height)
+    )
+
+def _paintSubrects(width: int, height: int, bytespp: int,
+        background: bytes, foreground: bytes, subrects: bytes, coloured: bool):
+    """
+    paints Hextile subrects (packed x/y and w/h bytes, optionally
+    prefixed with a pixel) onto a tile filled with the background
+    """
+    entrySize = bytespp + 2 if coloured else 2
+    count = len(subrects) // entrySize
+
+    if np is not None:
+        tile = np.empty((height, width, bytespp), np.uint8)
+        tile[:] = np.frombuffer(background, np.uint8)
+
+        entries = np.frombuffer(subrects, np.uint8).reshape(count, entrySize)
+        xy, wh = entries[:, -2], entries[:, -1]
+        sx, sy = xy >> 4, xy & 15
+        ex = (sx + (wh >> 4) + 1).tolist()
+        ey = (sy + (wh & 15) + 1).tolist()
+        sx, sy = sx.tolist(), sy.tolist()
+
+        if coloured:
+            pixels = entries[:, :bytespp]
+            for i in range(count):
+                tile[sy[i]:ey[i], sx[i]:ex[i]] = pixels[i]
+        else:
+            pixel = np.frombuffer(foreground, np.uint8)
+            for i in range(count):
+                tile[sy[i]:ey[i], sx[i]:ex[i]] = pixel
+        return tile
+
+    tile = bytearray(background * (width * height))
+    stride = width * bytespp
+
+    if coloured:
+        entries = s.iter_unpack(f"{bytespp}sBB", subrects)
+    else:
+        entries = ((foreground, xy, wh) for xy, wh in s.iter_unpack("BB", subrects))
+
+    for pixel, xy, wh in entries:
+        sx, sy = xy >> 4, xy & 15
+        w, h = (wh >> 4) + 1, (wh & 15) + 1
+        line = pixel * w
+        start = sy*stride + sx*bytespp
+        for row in range(start, start + h*stride, stride):
+            tile[row:row + len(line)] = line
+    return tile
+
+def _tpixelIsRGB(pixformat: RFBPixelformat) -> bool:
+    """
+    Tight sends 3 byte pixels (red, green, blue) for 32 bit formats
+    with a depth of 24, otherwise TPIXEL and PIXEL are the same
+    """
+    return (pixformat.truecolor and pixformat.bitspp == 32
+        and pixformat.depth == 24
+        and pixformat.redmax == pixformat.greenmax == pixformat.bluemax == 255)
+
+def _rgbToPixels(data: bytes, pixformat: RFBPixelformat):
+    """
+    converts packed RGB888 data to pixels in the given format,
+    returns a (n, bytespp) numpy array if numpy is available
+    """
+    count = len(data) // 3
+    bytespp = pixformat.bytespp
+    shifts = (pixformat.redshift, pixformat.greenshift, pixformat.blueshift)
+    maxes = (pixformat.redmax, pixformat.greenmax, pixformat.bluemax)
+
+    if bytespp == 4 and maxes == (255, 255, 255) and not any(shift % 8 for shift in shifts):
+        # every component is a byte of its own
+        if pixformat.bigendian:
+            planes = [3 - shift // 8 for shift in shifts]
+        else:
+            planes = [shift // 8 for shift in shifts]
+
+        if np is not None:
+            pixels = np.zeros((count, 4), np.uint8)
+            pixels[:, planes] = np.frombuffer(data, np.uint8).reshape(count, 3)
+            return pixels
+
+        pixels = bytearray(count * 4)
+        for i, plane in enumerate(planes):
+            pixels[plane::4] = data[i::3]
+        return pixels
+
+    # scale every component down to its maximum and shift it into place
+    order = ">" if pixformat.bigendian else "<"
+
+    if np is not None:
+        rgb = np.frombuffer(data, np.uint8).reshape(count, 3).astype(np.uint32)
+        values = np.zeros(count, np.uint32)
+        for i in range(3):
+            values |= (rgb[:, i] * maxes[i] // 255) << shifts[i]
+        return values.astype(f"{order}u{bytespp}").view(np.uint8).reshape(count, bytespp)
+
+    fmt = order + {1: "B", 2: "H", 4: "I"}[bytespp]
+    return b"".join(
+        s.pack(fmt, (r * maxes[0] // 255) << shifts[0]
+                    | (g * maxes[1] // 255) << shifts[1]
+                    | (b * maxes[2] // 255) << shifts[2])
+        for r, g, b in s.iter_unpack("BBB", data))
+
+def _expandTPixels(data: bytes, pixformat: RFBPixelformat):
+    if _tpixelIsRGB(pixformat):
+        return _rgbToPixels(data, pixformat)
+    return _expandCPixels(data, None, pixformat.bytespp)
+
+def _gradientFilter(data: bytes, width: int, height: int,
+        pixformat: RFBPixelformat) -> bytes:
+    """
+    reverses the Tight gradient filter, every pixel is a difference
+    to the prediction left + above - above left (per color component)
+    """
+    if np is not None:
+        return _gradientFilterNumpy(data, width, height, pixformat)
+
+    if _tpixelIsRGB(pixformat):
+        maxes = (255, 255, 255)
+        values = data
+    else:
+        order = ">" if pixformat.bigendian else "<"
+        fmt = order + {1: "B", 2: "H", 4: "I"}[pixformat.bytespp]
+        maxes = (pixformat.redmax, pixformat.greenmax, pixformat.bluemax)
+        shifts = (pixformat.redshift, pixformat.greenshift, pixformat.blueshift)
+        values = [
+            (pixel >> shift) & cmax
+            for pixel, in s.iter_unpack(fmt, data)
+            for cmax, shift in zip(maxes, shifts)
+        ]
+
+    rowSize = width * 3
+    result = [0] * (rowSize * height)
+    above = [0] * rowSize
+
+    for row in range(0, len(result), rowSize):
+        line = result[row:row + rowSize]
+        for i in range(rowSize):
+            cmax = maxes[i % 3]
+            if i < 3:
+                prediction = above[i]
+            else:
+                prediction = line[i - 3] + above[i] - above[i - 3]
+                prediction = 0 if prediction < 0 else min(prediction, cmax)
+            line[i] = (prediction + values[row + i]) & cmax
+        result[row:row + rowSize] = line
+        above = line
+
+    if _tpixelIsRGB(pixformat):
+        return _rgbToPixels(bytes(result), pixformat)
+
+    pixels = b"".join(
+        s.pack(fmt, (r << shifts[0]) | (g << shifts[1]) | (b << shifts[2]))
+        for r, g, b in zip(result[0::3], result[1::3], result[2::3]))
+    return _expandCPixels(pixels, None, pixformat.bytespp)
+
+def _gradientFilterNumpy(data: bytes, width: int, height: int,
+        pixformat: RFBPixelformat):
+    """
+    _gradientFilter() one anti-diagonal at a time, all pixels on it only
+    depend on the two diagonals before, so each one is a single vector step.
+    Several times faster than the plain loop but still width + height
+    steps per rectangle, with jpegQuality set servers send JPEG instead
+    for photo-like content
+    """
+    rgb = _tpixelIsRGB(pixformat)
+    if rgb:
+        maxes = np.array((255, 255, 255), np.int32)
+        values = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+    else:
+        order = ">" if pixformat.bigendian else "<"
+        maxes = np.array((pixformat.redmax, pixformat.greenmax, pixformat.bluemax), np.int32)
+        shifts = np.array(
+            (pixformat.redshift, pixformat.greenshift, pixformat.blueshift), np.int32)
+        pixels = np.frombuffer(data, f"{order}u{pixformat.bytespp}").astype(np.int32)
+        values = (pixels[:, None] >> shifts) & maxes
+        values = values.reshape(height, width, 3)
+
+    # the prediction is the same with rows and columns swapped,
+    # the diagonals are shorter and less of them are empty that way
+    transposed = height > width
+    if transposed:
+        values = values.transpose(1, 0, 2)
+        width, height = height, width
+
+    # skewed, so that diagonal k holds the pixels (y, k - y) in a row,
+    # with zeros around them. Left and above of a pixel are on the diagonal
+    # before, above left on the one before that, all of them contiguous
+    diagonals = width + height - 1
+    ys, xs = np.mgrid[0:height, 0:width]
+    skewed = np.zeros((diagonals, height, 3), np.int32)
+    skewed[ys + xs, ys] = values
+    skewed = skewed.reshape(-1)
+
+    rowSize = (height + 1) * 3
+    result = np.zeros((diagonals + 2) * rowSize, np.int32)
+    limits = np.tile(maxes, height)
+    prediction = np.empty(height * 3, np.int32)
+
+    for diagonal in range(diagonals):
+        first = max(0, diagonal - width + 1) * 3
+        size = (min(height - 1, diagonal) + 1) * 3 - first
+        current = (diagonal + 2) * rowSize + first + 3
+        left = current - rowSize
+        above = left - 3
+        aboveLeft = above - rowSize
+        pred, cmax = prediction[:size], limits[:size]
+
+        np.add(result[left:left + size], result[above:above + size], out=pred)
+        pred -= result[aboveLeft:aboveLeft + size]
+        np.maximum(pred, 0, out=pred)
+        np.minimum(pred, cmax, out=pred)
+        value = diagonal * height * 3 + first
+        pred += skewed[value:value + size]
+        np.bitwise_and(pred, cmax, out=result[current:current + size])
+
+    result = result.reshape(diagonals + 2, height + 1, 3)[ys + xs + 2, ys + 1]
+    if transposed:
+        result = result.transpose(1, 0, 2)
+    if rgb:
+        return _rgbToPixels(result.astype(np.uint8).tobytes(), pixformat)
+
+    pixels = (result.astype(np.int64) << shifts).sum(axis=2)
+    return _expandCPixels(
+        pixels.astype(f"{order}u{pixformat.bytespp}").tobytes(), None, pixformat.bytespp)
+
+_jpegPool: ThreadPoolExecutor = None
+
+def _submitJPEG(*args) -> Future:
+    """
+    decodes a Tight JPEG rectangle on the worker pool, see _decodeJPEG()
+    """
+    global _jpegPool
+    if _jpegPool is None:
+        _jpegPool = ThreadPoolExecutor(JPEG_WORKERS, thread_name_prefix="RFB JPEG")
+    return _jpegPool.submit(_decodeJPEG, *args)
+
+def _decodeJPEG(data: bytes, width: int, height: int,
+        pixformat: RFBPixelformat):
+    """
+    decodes a Tight JPEG rectangle to pixels in the given format,
+    this runs on the JPEG worker threads
+    """
+    image = QImage.fromData(data, "JPEG")
+    if image.isNull() or image.width() != width or image.height() != height:
+        raise RFBUnexpectedResponse("Invalid JPEG data received")
+
+    nativeRGB32 = (
+        pixformat.truecolor and pixformat.bitspp == 32
+        and pixformat.redmax == pixformat.greenmax == pixformat.bluemax == 255
+        and (pixformat.redshift, pixformat.greenshift, pixformat.blueshift) == (16, 8, 0)
+        and pixformat.bigendian == (sys.byteorder == "big")
+    )
+
+    # Format_RGB32 rows are always 4 byte aligned, so no padding to strip
+    image = image.convertToFormat(
+        QImage.Format_RGB32 if nativeRGB32 else QImage.Format_RGB888)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * height)
+    pixels = bits.asstring()
+
+    if nativeRGB32:
+        return pixels
+
+    rowSize = width * 3
+    bpl = image.bytesPerLine()
+    if bpl != rowSize:
+        pixels = b"".join(
+            pixels[row*bpl:row*bpl + rowSize] for row in range(height))
+    return _rgbToPixels(pixels, pixformat)
+
+def _applyPalette(indices, palette, bytespp: int):
+    """
+    maps palette indices to pixels, palette is the output of _expandCPixels()
+    """
+    if np is not None:
+        if not isinstance(indices, np.ndarray):
+            indices = np.frombuffer(indices, np.uint8)
+        return palette[indices]
+
+    # map every byte of the pixel separately, translate() does the heavy lifting
+    pixels = bytearray(len(indices) * bytespp)
+    for plane in range(bytespp):
+        table = bytes(palette[plane::bytespp]).ljust(256, b"\0")
+        pixels[plane::bytespp] = indices.translate(table)
+    return pixels
+
+def _parseFrom(read, parser):
+    """
+    runs a parser generator on data which is already there, read(size)
+    returns the next size bytes (like io.BytesIO(data).read)
+    """
+    try:
+        size = next(parser)
+        while True:
+            size = parser.send(read(size))
+    except StopIteration as e:
+        return e.value
+
+# ------------------------------------------------------------------
+## Decoders
+# ------------------------------------------------------------------
+
+class RFBDecoder:
+    """
+    Decodes rectangles of one encoding into the client framebuffer.
+    Decoders are registered with RFBClient.registerDecoder() and keep their
+    own state (zlib streams, palettes, ...), which is reset for every new
+    connection.
+
+    decode() does not read from the connection itself, it is a generator
+    yielding what it needs next (see RFBClient._parse()), so the same decoder
+    works with RFBClient and AsyncRFBClient. Decoders which do not read
+    anything can be plain functions.
+    """
+    encoding: int = None
+
+    def reset(self):
+        """
+        called for every new connection before any rectangle is decoded
+        """
 
-MAX_BUFF_SIZE: int = 10*1024*1024 # 10MB
+    def close(self):
+        """
+        called when the connection gets closed, free resources here
+        """
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        raise NotImplementedError
+
+class RawDecoder(RFBDecoder):
+    encoding = c.ENC_RAW
+
+    def __init__(self):
+        self._scratch = bytearray()
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        xPos, yPos, width, height = rectangle.asTuple()
+        rowSize = width * fb.bytespp
+
+        if xPos == 0 and width == fb.width:
+            # full width rows are contiguous in the framebuffer,
+            # so the whole rectangle can be received in one go
+            start = fb.offset(0, yPos)
+            yield fb.view[start:start + height*fb.stride]
+        else:
+            # receive into a reusable buffer and copy the rows over,
+            # one recv per row would be way more expensive
+            size = rowSize * height
+            if len(self._scratch) < size:
+                self._scratch = bytearray(size)
+            scratch = memoryview(self._scratch)[:size]
+            yield scratch
+
+            for row in range(height):
+                start = fb.offset(xPos, yPos + row)
+                fb.view[start:start + rowSize] = \
+                    scratch[row*rowSize:(row + 1)*rowSize]
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+class CopyRectDecoder(RFBDecoder):
+    encoding = c.ENC_COPYRECT
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        srcX, srcY = s.unpack("!HH", (yield 4))
+
+        source = RFBRectangle(srcX, srcY, rectangle.width, rectangle.height)
+        yield from client._waitDeferred(source)
+        client._flushDeferred(source)
+        client.framebuffer.copyRect(srcX, srcY, *rectangle.asTuple())
+
+        client.onFramebufferChanged(*rectangle.asTuple())
+        client.onCopyRectangle(srcX, srcY, *rectangle.asTuple())
+
+class RREDecoder(RFBDecoder):
+    encoding = c.ENC_RRE
+    subrectFormat = "HHHH"
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        bytespp = fb.bytespp
+        xPos, yPos, width, height = rectangle.asTuple()
+
+        count = es.return_uint32_val((yield 4), True)
+        fb.fill(xPos, yPos, width, height, (yield bytespp))
+
+        # read all subrects at once, then fill them one after another
+        entry = s.Struct(f"!{bytespp}s{self.subrectFormat}")
+        subrects = yield count * entry.size
+
+        if fb.array is not None:
+            pixels = np.frombuffer(subrects, np.uint8).reshape(
+                count, entry.size)[:, :bytespp]
+            for i, (_, sx, sy, w, h) in enumerate(entry.iter_unpack(subrects)):
+                fb.array[yPos + sy:yPos + sy + h, xPos + sx:xPos + sx + w] = pixels[i]
+        else:
+            for pixel, sx, sy, w, h in entry.iter_unpack(subrects):
+                fb.fill(xPos + sx, yPos + sy, w, h, pixel)
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+class CoRREDecoder(RREDecoder):
+    encoding = c.ENC_CORRE
+    subrectFormat = "BBBB"
+
+class ZlibDecoder(RFBDecoder):
+    encoding = c.ENC_ZLIB
+
+    def reset(self):
+        self._stream = zlib.decompressobj()
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        length = es.return_uint32_val((yield 4), True)
+        data = self._stream.decompress((yield length))
+
+        client.framebuffer.putRect(*rectangle.asTuple(), data)
+        client.onFramebufferChanged(*rectangle.asTuple())
+
+class HextileDecoder(RFBDecoder):
+    encoding = c.ENC_HEXTILE
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        bytespp = fb.bytespp
+        xPos, yPos, width, height = rectangle.asTuple()
+
+        # background and foreground carry over from tile to tile
+        self._background = self._foreground = bytes(bytespp)
+
+        for ty in range(yPos, yPos + height, HEXTILE_TILE_SIZE):
+            th = min(HEXTILE_TILE_SIZE, yPos + height - ty)
+
+            for tx in range(xPos, xPos + width, HEXTILE_TILE_SIZE):
+                tw = min(HEXTILE_TILE_SIZE, xPos + width - tx)
+                subencoding = (yield 1)[0]
+
+                if subencoding & c.HEXTILE_RAW:
+                    fb.putRect(tx, ty, tw, th, (yield tw * th * bytespp))
+                else:
+                    yield from self.decodeTile(fb, subencoding, tx, ty, tw, th)
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+    def decodeTile(self, fb: RFBFramebuffer, subencoding: int,
+            xPos: int, yPos: int, width: int, height: int):
+        bytespp = fb.bytespp
+
+        if subencoding & c.HEXTILE_BACKGROUND:
+            self._background = yield bytespp
+        if subencoding & c.HEXTILE_FOREGROUND:
+            self._foreground = yield bytespp
+
+        if not subencoding & c.HEXTILE_ANY_SUBRECTS:
+            fb.fill(xPos, yPos, width, height, self._background)
+            return
+
+        # all subrects of a tile are read at once and painted into
+        # a tile sized buffer, which then gets written in one go
+        count = (yield 1)[0]
+        coloured = subencoding & c.HEXTILE_SUBRECTS_COLOURED
+        subrects = yield count * (bytespp + 2 if coloured else 2)
+
+        fb.putRect(xPos, yPos, width, height, _paintSubrects(
+            width, height, bytespp,
+            self._background, self._foreground, subrects, coloured))
+
+class ZlibHexDecoder(HextileDecoder):
+    """
+    Hextile with optionally zlib compressed raw tiles and tile data,
+    using one stream for each of them
+    """
+    encoding = c.ENC_ZLIBHEX
+
+    def reset(self):
+        self._rawStream = zlib.decompressobj()
+        self._hexStream = zlib.decompressobj()
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        bytespp = fb.bytespp
+        xPos, yPos, width, height = rectangle.asTuple()
+
+        self._background = self._foreground = bytes(bytespp)
+
+        for ty in range(yPos, yPos + height, HEXTILE_TILE_SIZE):
+            th = min(HEXTILE_TILE_SIZE, yPos + height - ty)
+
+            for tx in range(xPos, xPos + width, HEXTILE_TILE_SIZE):
+                tw = min(HEXTILE_TILE_SIZE, xPos + width - tx)
+                subencoding = (yield 1)[0]
+
+                if subencoding & c.HEXTILE_ZLIB_RAW:
+                    length = es.return_uint16_val((yield 2), True)
+                    fb.putRect(tx, ty, tw, th,
+                        self._rawStream.decompress((yield length)))
+
+                elif subencoding & c.HEXTILE_RAW:
+                    fb.putRect(tx, ty, tw, th, (yield tw * th * bytespp))
+
+                elif subencoding & c.HEXTILE_ZLIB_HEX:
+                    length = es.return_uint16_val((yield 2), True)
+                    data = self._hexStream.decompress((yield length))
+                    _parseFrom(io.BytesIO(data).read,
+                        self.decodeTile(fb, subencoding, tx, ty, tw, th))
+
+                else:
+                    yield from self.decodeTile(fb, subencoding, tx, ty, tw, th)
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+class TRLEDecoder(RFBDecoder):
+    """
+    Tiled run-length encoding, tiles are read directly from the socket.
+    The palette is kept between tiles, so it can be reused.
+    """
+    encoding = c.ENC_TRLE
+    tileSize = 16
+
+    def reset(self):
+        self._palette = None
+        self._paletteSize = 0
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        yield from self.decodeTiles(client, rectangle)
+
+    def decodeTiles(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        bytespp = fb.bytespp
+        padding = _cpixelPadding(client.pixformat)
+        cpixelSize = bytespp if padding is None else 3
+        xPos, yPos, width, height = rectangle.asTuple()
+
+        for ty in range(yPos, yPos + height, self.tileSize):
+            th = min(self.tileSize, yPos + height - ty)
+
+            for tx in range(xPos, xPos + width, self.tileSize):
+                tw = min(self.tileSize, xPos + width - tx)
+                subencoding = (yield 1)[0]
+
+                if subencoding == 0:
+                    # raw
+                    fb.putRect(tx, ty, tw, th, _expandCPixels(
+                        (yield tw * th * cpixelSize), padding, bytespp))
+
+                elif subencoding == 1:
+                    # solid
+                    pixel = _expandCPixels((yield cpixelSize), padding, bytespp)
+                    fb.fill(tx, ty, tw, th, bytes(pixel))
+
+                elif subencoding <= 16 or subencoding == 127:
+                    # packed palette, 127 reuses the previous one
+                    if subencoding != 127:
+                        self._paletteSize = subencoding
+                        self._palette = _expandCPixels(
+                            (yield subencoding * cpixelSize), padding, bytespp)
+
+                    bits = 1 if self._paletteSize == 2 else \
+                        2 if self._paletteSize <= 4 else 4
+                    indices = _unpackIndices(
+                        (yield ((tw*bits + 7) // 8) * th), bits, tw, th)
+                    fb.putRect(tx, ty, tw, th,
+                        _applyPalette(indices, self._palette, bytespp))
+
+                elif subencoding == 128:
+                    # plain RLE
+                    pixels, runs = list(), list()
+                    count = tw * th
+
+                    while count > 0:
+                        # a pixel is always followed by a run length byte
+                        entry = yield cpixelSize + 1
+                        pixels.append(entry[:-1])
+                        run = 1 + entry[-1]
+                        if entry[-1] == 255:
+                            run += yield from self._readRunLength()
+                        runs.append(run)
+                        count -= run
+
+                    if np is not None:
+                        tile = np.repeat(_expandCPixels(
+                            b"".join(pixels), padding, bytespp), runs, axis=0)
+                    else:
+                        tile = _expandCPixels(b"".join(
+                            p * r for p, r in zip(pixels, runs)), padding, bytespp)
+                    fb.putRect(tx, ty, tw, th, tile)
+
+                elif subencoding >= 129:
+                    # palette RLE, 129 reuses the previous palette
+                    if subencoding != 129:
+                        self._paletteSize = subencoding - 128
+                        self._palette = _expandCPixels(
+                            (yield self._paletteSize * cpixelSize), padding, bytespp)
+
+                    indices, runs = list(), list()
+                    count = tw * th
+
+                    while count > 0:
+                        index = (yield 1)[0]
+                        run = 1
+                        if index & 128:
+                            value = (yield 1)[0]
+                            run += value
+                            if value == 255:
+                                run += yield from self._readRunLength()
+                        indices.append(index & 127)
+                        runs.append(run)
+                        count -= run
+
+                    if np is not None:
+                        indices = np.repeat(np.array(indices, np.uint8), runs)
+                    else:
+                        indices = b"".join(
+                            _SINGLE_BYTES[i] * r for i, r in zip(indices, runs))
+                    fb.putRect(tx, ty, tw, th,
+                        _applyPalette(indices, self._palette, bytespp))
+
+                else:
+                    raise RFBUnexpectedResponse(
+                        f"Invalid TRLE/ZRLE subencoding {subencoding}")
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+    @staticmethod
+    def _readRunLength() -> int:
+        """
+        rest of a run length, after a first byte of 255
+        """
+        run = 0
+        while True:
+            value = (yield 1)[0]
+            run += value
+            if value != 255:
+                return run
+
+class ZRLEDecoder(TRLEDecoder):
+    """
+    TRLE with 64x64 tiles, compressed with a single zlib stream
+    for the whole connection
+    """
+    encoding = c.ENC_ZRLE
+    tileSize = 64
+
+    def reset(self):
+        super().reset()
+        self._stream = zlib.decompressobj()
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        length = es.return_uint32_val((yield 4), True)
+        data = self._stream.decompress((yield length))
+        _parseFrom(io.BytesIO(data).read, self.decodeTiles(client, rectangle))
+
+class TightDecoder(RFBDecoder):
+    encoding = c.ENC_TIGHT
+
+    def reset(self):
+        self._streams = [zlib.decompressobj() for _ in range(4)]
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        fb = client.framebuffer
+        pixformat = client.pixformat
+        xPos, yPos, width, height = rectangle.asTuple()
+        tpixelSize = 3 if _tpixelIsRGB(pixformat) else fb.bytespp
+
+        control = (yield 1)[0]
+        for i in range(4):
+            if control & (1 << i):
+                self._streams[i] = zlib.decompressobj()
+        compression = control >> 4
+
+        if compression == c.TIGHT_FILL:
+            pixel = _expandTPixels((yield tpixelSize), pixformat)
+            fb.fill(xPos, yPos, width, height, bytes(pixel))
+
+        elif compression == c.TIGHT_JPEG:
+            length = yield from self._readCompactLength()
+            data = yield length
+
+            # decoding happens on the worker pool while the client goes on
+            # reading the socket, the result is written back later on
+            client._deferRectangle(
+                rectangle, _submitJPEG(data, width, height, pixformat))
+            return
+
+        elif compression & 8:
+            raise RFBUnexpectedResponse(
+                f"Unsupported Tight compression {compression}")
+
+        else:
+            stream = compression & 3
+            filterType = c.TIGHT_FILTER_COPY
+            if compression & c.TIGHT_EXPLICIT_FILTER:
+                filterType = (yield 1)[0]
+
+            if filterType == c.TIGHT_FILTER_COPY:
+                data = yield from self._readData(width*height*tpixelSize, stream)
+                pixels = _expandTPixels(data, pixformat)
+
+            elif filterType == c.TIGHT_FILTER_PALETTE:
+                numColors = (yield 1)[0] + 1
+                palette = _expandTPixels(
+                    (yield numColors*tpixelSize), pixformat)
+
+                if numColors == 2:
+                    data = yield from self._readData(((width + 7) // 8) * height, stream)
+                    indices = _unpackIndices(data, 1, width, height)
+                else:
+                    indices = yield from self._readData(width*height, stream)
+                pixels = _applyPalette(indices, palette, fb.bytespp)
+
+            elif filterType == c.TIGHT_FILTER_GRADIENT:
+                data = yield from self._readData(width*height*tpixelSize, stream)
+                pixels = _gradientFilter(data, width, height, pixformat)
+
+            else:
+                raise RFBUnexpectedResponse(
+                    f"Unknown Tight filter {filterType}")
+
+            fb.putRect(xPos, yPos, width, height, pixels)
+
+        client.onFramebufferChanged(xPos, yPos, width, height)
+
+    def _readData(self, size: int, stream: int) -> bytes:
+        # small amounts of data are sent without compression
+        if size < c.TIGHT_MIN_TO_COMPRESS:
+            return (yield size)
+
+        length = yield from self._readCompactLength()
+        return self._streams[stream].decompress((yield length))
+
+    @staticmethod
+    def _readCompactLength() -> int:
+        length = 0
+        for i in range(3):
+            value = (yield 1)[0]
+            if i == 2:
+                return length | (value << 14)
+            length |= (value & 0x7f) << (7 * i)
+            if not value & 0x80:
+                return length
+
+class CursorDecoder(RFBDecoder):
+    """
+    pseudo-encoding, the server sends the cursor shape instead of
+    drawing it into the framebuffer. Not registered by default, only
+    clients drawing the cursor in onCursorUpdate() should register it.
+    """
+    encoding = c.ENC_CURSOR
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        hotX, hotY, width, height = rectangle.asTuple()
+
+        pixels = yield width * height * client.pixformat.bytespp
+        # 1 bit per pixel, rows are padded to full bytes
+        mask = yield (width + 7) // 8 * height
+
+        client.onCursorUpdate(hotX, hotY, width, height, pixels, mask)
+
+class DesktopSizeDecoder(RFBDecoder):
+    """
+    pseudo-encoding, the remote desktop changed its size
+    """
+    encoding = c.ENC_DESKTOPSIZE
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        yield from client._waitDeferred()
+        client._resizeFramebuffer(rectangle.width, rectangle.height)
+
+class ExtendedDesktopSizeDecoder(RFBDecoder):
+    """
+    pseudo-encoding, like DesktopSize but including the screen layout.
+    xPos is the reason of the change, yPos the status of a change
+    requested by this client
+    """
+    encoding = c.ENC_EXTENDED_DESKTOPSIZE
+
+    def decode(self, client: "RFBClient", rectangle: RFBRectangle):
+        reason, status, width, height = rectangle.asTuple()
+
+        numScreens = s.unpack("!Bxxx", (yield 4))[0]
+        client.screens = list(s.iter_unpack("!IHHHHI", (yield numScreens * 16)))
+        client.log.debug(f"Screen layout ({reason}, {status}): {client.screens}")
+
+        # on errors the size is the current one
+        if (width, height) != (client.vncWidth, client.vncHeight):
+            yield from client._waitDeferred()
+            client._resizeFramebuffer(width, height)
+
+# in priority order, the server uses the first one it supports
+DEFAULT_DECODERS = [
+    TightDecoder,
+    ZRLEDecoder,
+    ZlibHexDecoder,
+    ZlibDecoder,
+    TRLEDecoder,
+    HextileDecoder,
+    CoRREDecoder,
+    RREDecoder,
+    CopyRectDecoder,
+    RawDecoder,
+    ExtendedDesktopSizeDecoder,
+    DesktopSizeDecoder
+]
+
+class RFBWriter:
+    """
+    Sends client messages from its own thread, so callers never wait for
+    the socket. Everything queued while a send is running goes out in a
+    single sendall(), a queued message with the same mergeKey as the one
+    before it replaces that one (e.g. pointer motion).
+
+    When sending fails the exception is kept in error, nothing is sent
+    anymore and the connection is shut down.
+    """
+    log = logging.getLogger("RFB Writer")
+
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self.error: Exception = None
+
+        self._queue = list() # list[tuple[mergeKey, bytes]]
+        self._condition = Condition()
+        self._closed = False
+        self._held = 0
+
+        self._thread = Thread(target=self._run, name="RFB writer", daemon=True)
+        self._thread.start()
+
+    def send(self, data: bytes, mergeKey = None):
+        with self._condition:
+            if self._closed:
+                return
+            if mergeKey is not None and self._queue and self._queue[-1][0] == mergeKey:
+                self._queue[-1] = (mergeKey, data)
+            else:
+                self._queue.append((mergeKey, data))
+            self._condition.notify()
+
+    def hold(self):
+        """
+        keeps everything queued from now on until release(),
+        so it goes out in a single write
+        """
+        with self._condition:
+            self._held += 1
+
+    def release(self):
+        with self._condition:
+            self._held -= 1
+            self._condition.notify()
+
+    def close(self):
+        """
+        drops everything not sent yet, the thread exits once
+        a running send is done or failed
+        """
+        with self._condition:
+            self._closed = True
+            self._queue = list()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while (not self._queue or self._held) and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                pending, self._queue = self._queue, list()
+
+            try:
+                self.connection.sendall(b"".join(data for _, data in pending))
+            except OSError as e:
+                self.log.debug(f"Sending failed: {e}")
+                self.error = e
+                self.close()
+                # the reading side notices the broken connection this way
+                # and reports error, see RFBClient._mainRequestLoop()
+                try:
+                    self.connection.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+                return
 
 class RFBClient:
 
@@ -63,6 +1071,10 @@ class RFBClient:
     logs = logging.getLogger("RFB Client <-")
 
     pixformat: RFBPixelformat
+    framebuffer: RFBFramebuffer = None
+    _writer: RFBWriter = None
+    screens = list() # list[tuple[id, x, y, width, height, flags]]
+    colorMap = list() # 0xffRRGGBB of every pixel value without truecolor
     numRectangles = 0
     #rectanglePositions = list() # list[RFBRectangle]
 
@@ -71,60 +1083,320 @@ class RFBClient:
     _requestFrameBufferUpdate = False
     _incrementalFrameBufferUpdate = True
 
+    _supportsContinuousUpdates = False
+    _continuousUpdatesActive = False
+    # turned off for flow control or while paused,
+    # turned on again after the next update
+    _continuousUpdatesSuspended = False
+    _supportsFence = False
+    _fenceSentAt: int = None
+
+    _preferredEncoding: int = None
+    # part of the screen to request, None for all of it
+    updateRegion: tuple = None # tuple[x, y, width, height]
+    _updatesPaused = False
+    _pendingPixelFormat: RFBPixelformat = None
+    _fullUpdateNeeded = False
+
     def __init__(self, host, port = 5900,
                 password: str = None, 
                 sharedConnection = True,
                 keepRequesting = True,
-                requestIncremental = True):
+                requestIncremental = True,
+                requestWindow = 1,
+                jpegQuality: int = None,
+                compressLevel: int = None,
+                continuousUpdates = True,
+                adaptiveEncoding = False,
+                maxFps: float = None,
+                tcpNoDelay = True,
+                keepAlive = True,
+                connectTimeout: float = 10.0,
+                recvBufferSize: int = None,
+                sendBufferSize: int = None):
+        """
+        requestWindow is the number of update requests kept in flight,
+        more than 1 hides network latency on servers without
+        continuous updates
+
+        jpegQuality (0 - 9) allows the server to send JPEG compressed
+        rectangles using the Tight encoding, None keeps it lossless
+
+        compressLevel (0 - 9) trades server CPU time for bandwidth,
+        None leaves it up to the server
+
+        continuousUpdates lets servers supporting the ContinuousUpdates
+        extension push updates without waiting for a request each time
+
+        adaptiveEncoding picks the preferred encoding, jpegQuality,
+        compressLevel and between 32 and 16 bit pixels depending on the
+        measured throughput, see ADAPTIVE_PROFILES
+
+        maxFps limits how often updates are requested, None requests the
+        next one as soon as the previous one arrived. With continuous
+        updates the server decides how often it sends them.
+
+        tcpNoDelay sends small messages like input events right away
+        instead of waiting to fill a packet (Nagle's algorithm)
+
+        keepAlive detects dead connections, see KEEPALIVE_*
+
+        connectTimeout is the time in seconds connecting may take,
+        None waits as long as the OS does
+
+        recvBufferSize and sendBufferSize set the socket buffers in bytes,
+        None keeps the OS defaults, which on Linux grow automatically.
+        Fixed large receive buffers help RAW updates on links with a
+        high bandwidth-delay product.
+        """
         self.host = host
         self.port = port
         self.password = password
         self.sharedConn = sharedConnection
         self._requestFrameBufferUpdate = keepRequesting
         self._incrementalFrameBufferUpdate = requestIncremental
+        self.requestWindow = max(1, requestWindow)
+        self.jpegQuality = jpegQuality
+        self.compressLevel = compressLevel
+        self.continuousUpdates = continuousUpdates
+        self.adaptiveEncoding = adaptiveEncoding
+        self.__resetAdaptive()
+        self.maxFps = maxFps
+        self._lastRequestAt = 0.0
+        # requests held back by maxFps, sent from the main loop
+        self._requestsDue = 0
+        # update requests sent and not answered yet
+        self._requestsInFlight = 0
+
+        # update region and pause state as set by other threads (the GUI),
+        # applied by the RFB thread in _applyControl()
+        self._controlLock = Lock()
+        self._requestedRegion: tuple = None
+        self._requestedPause = False
+        # wakes the main loop up to apply them, see _wakeUp()
+        self._wakeupSockets: tuple = None # tuple[socket, socket]
+
+        self.tcpNoDelay = tcpNoDelay
+        self.keepAlive = keepAlive
+        self.connectTimeout = connectTimeout
+        self.recvBufferSize = recvBufferSize
+        self.sendBufferSize = sendBufferSize
 
         self._mainLoop: Thread = None
-
-    def __recv(self, expectedSize: int = None, maxSize=MAX_BUFF_SIZE) -> bytes:
+        self._deferredRects = list() # list[tuple[RFBRectangle, Future]]
+
+        self.decoders = dict() # encoding -> RFBDecoder, in priority order
+        for decoder in DEFAULT_DECODERS:
+            self.registerDecoder(decoder())
+        self.__resetRecvBuffer()
+
+    def __resetRecvBuffer(self):
+        # read ahead buffer, data between _recvStart and _recvEnd is pending
+        self._recvBuffer = bytearray(RECV_BUFF_SIZE)
+        self._recvStart = 0
+        self._recvEnd = 0
+        self._bytesReceived = 0
+        # time spent blocked in recv, for measuring throughput
+        self._recvWaited = 0.0
+
+    def __resetAdaptive(self):
+        self._throughput = RFBThroughput()
+        self._profile: int = None # index in ADAPTIVE_PROFILES
+        self._profileCandidate: int = None
+        self._profileVotes = 0
+        self._profileSwitchedAt = 0.0
+        # pixel format to go back to from lowColor profiles
+        self._fullPixelFormat: RFBPixelformat = None
+
+    def __fillRecvBuffer(self, size: int):
+        """
+        reads from the socket until at least size bytes are buffered
+        or the connection got closed
+        """
+        available = self._recvEnd - self._recvStart
+
+        if self._recvStart + size > len(self._recvBuffer):
+            # move pending data to the front and grow if needed
+            if size > len(self._recvBuffer):
+                newBuffer = bytearray(size)
+                newBuffer[:available] = \
+                    self._recvBuffer[self._recvStart:self._recvEnd]
+                self._recvBuffer = newBuffer
+            else:
+                self._recvBuffer[:available] = \
+                    self._recvBuffer[self._recvStart:self._recvEnd]
+            self._recvStart, self._recvEnd = 0, available
+
+        with memoryview(self._recvBuffer) as view:
+            while self._recvEnd - self._recvStart < size:
+                waitStart = time.perf_counter()
+                count = self.connection.recv_into(view[self._recvEnd:])
+                self._recvWaited += time.perf_counter() - waitStart
+                if not count:
+                    break
+                self._recvEnd += count
+                self._bytesReceived += count
+
+    def _recv(self, expectedSize: int = None, maxSize=MAX_BUFF_SIZE) -> bytes:
         if expectedSize == 0:
             return b""
 
         if not expectedSize:
-            buffer = self.connection.recv(4096)
-        else:
-            buffer = self.connection.recv(expectedSize, socket.MSG_WAITALL)    
+            if self._recvEnd == self._recvStart:
+                self.__fillRecvBuffer(1)
+            expectedSize = min(self._recvEnd - self._recvStart, maxSize)
+        elif self._recvEnd - self._recvStart < expectedSize:
+            self.__fillRecvBuffer(expectedSize)
+
+        start = self._recvStart
+        end = min(start + expectedSize, self._recvEnd)
+        self._recvStart = end
+
+        with memoryview(self._recvBuffer) as view:
+            buffer = bytes(view[start:end])
 
         if not buffer:
             return buffer
 
-        if len(buffer) <= 50:
-            self.logs.debug(f"len: {len(buffer)} | {buffer.hex()}")
-        else:
-            self.logs.debug(f"{len(buffer)} Bytes | {len(buffer)//1024} KB")
+        if self.logs.isEnabledFor(logging.DEBUG):
+            if len(buffer) <= 50:
+                self.logs.debug(f"len: {len(buffer)} | {buffer.hex()}")
+            else:
+                self.logs.debug(f"{len(buffer)} Bytes | {len(buffer)//1024} KB")
 
         return buffer
 
-    def __send(self, data: bytes):
-        self.connection.send(data)
-        self.logc.debug(data.hex())
+    def _recvInto(self, buffer: memoryview):
+        """
+        fills the whole buffer with data from the socket
+        without allocating intermediate bytes objects
+        """
+        size = len(buffer)
+
+        # hand out what has been read ahead already
+        received = min(size, self._recvEnd - self._recvStart)
+        if received:
+            start = self._recvStart
+            with memoryview(self._recvBuffer) as view:
+                buffer[:received] = view[start:start + received]
+            self._recvStart += received
+
+        while received < size:
+            waitStart = time.perf_counter()
+            count = self.connection.recv_into(
+                buffer[received:], size - received, socket.MSG_WAITALL)
+            self._recvWaited += time.perf_counter() - waitStart
+            if not count:
+                raise RFBNoResponse("Connection closed while receiving data")
+            received += count
+            self._bytesReceived += count
+
+        if self.logs.isEnabledFor(logging.DEBUG):
+            self.logs.debug(f"{size} Bytes | {size//1024} KB (in place)")
+
+    def _parse(self, parser):
+        """
+        runs a parser generator with blocking reads from the socket.
+        Parsers (message handlers and decoders) yield what they need next:
+        - the number of bytes, which are sent back
+        - a memoryview, which is filled in place
+        - a Future of a background decoder, which is waited for
+
+        and return their result. AsyncRFBClient runs the same parsers
+        on an asyncio event loop.
+        """
+        try:
+            request = next(parser)
+            while True:
+                if type(request) is int:
+                    request = parser.send(self._recv(request))
+                elif isinstance(request, Future):
+                    futures.wait((request,))
+                    request = next(parser)
+                else:
+                    self._recvInto(request)
+                    request = next(parser)
+        except StopIteration as e:
+            return e.value
+
+    def _send(self, data: bytes, mergeKey = None):
+        """
+        queues data for the writer thread, see RFBWriter
+        """
+        self._writer.send(data, mergeKey)
+        if self.logc.isEnabledFor(logging.DEBUG):
+            self.logc.debug(data.hex())
+
+    @contextmanager
+    def _sendBatch(self):
+        """
+        everything sent inside the with block goes out in a single write
+        """
+        self._writer.hold()
+        try:
+            yield
+        finally:
+            self._writer.release()
 
     def __start(self):
+        self.__resetRecvBuffer()
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._configureSocket(self.connection)
+
+        self.connection.settimeout(self.connectTimeout)
         self.connection.connect( (self.host, self.port) )
-        self._handleInitial()
+        self.connection.settimeout(None)
+
+        self._writer = RFBWriter(self.connection)
+        self._wakeupSockets = socket.socketpair()
+        for sock in self._wakeupSockets:
+            sock.setblocking(False)
+        self._parse(self._handleInitial())
+
+        if self._connected:
+            self._mainRequestLoop()
+
+    def _configureSocket(self, sock: socket.socket):
+        """
+        applies the connection options, before connecting
+        so buffer sizes are part of the TCP handshake
+        """
+        if self.tcpNoDelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if self.recvBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recvBufferSize)
+        if self.sendBufferSize:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendBufferSize)
+
+        if self.keepAlive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # not available everywhere, the OS defaults apply then
+            for option, value in (
+                    ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                    ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                    ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
 
     def __close(self):
         self.log.debug("Closing connection")
 
+        if self._writer:
+            self._writer.close()
         if self.connection:
             try:
                 self.connection.shutdown(SHUT_RDWR)
                 self.connection.close()
             except OSError:
                 self.log.debug("TCP Connection already closed")
+        if self._wakeupSockets:
+            for sock in self._wakeupSockets:
+                sock.close()
+            self._wakeupSockets = None
 
     def _handleInitial(self):
-        buffer = self.__recv(12)
+        buffer = yield 12
 
         if b'\n' in buffer and buffer.startswith(b'RFB'):
             maj, min = [int(x) for x in buffer[3:-1].split(b'.')]
@@ -148,12 +1420,12 @@ class RFBClient:
 
         # request supported RFB version
         self.log.debug(f"Requesting RFB {maj}.{min}")
-        self.__send(f"RFB 00{maj}.00{min}\n".encode())
+        self._send(f"RFB 00{maj}.00{min}\n".encode())
 
         self.log.info("connected to VNC server")
 
         if (maj, min) == (3,3):
-            self._handleAuth33(self.__recv(4))
+            yield from self._handleAuth33((yield 4))
 
         else:
             self.log.error(f"Missing AUTH implementation for {maj}.{min}")
@@ -166,19 +1438,19 @@ class RFBClient:
         auth = es.return_uint32_val(data, True)
 
         if auth == c.AUTH_FAIL:
-            self._handleConnFailed(self.__recv(4))
+            yield from self._handleConnFailed((yield 4))
         elif auth == c.AUTH_NONE:
-            self._doClientInit()
+            yield from self._doClientInit()
         elif auth == c.AUTH_VNCAUTH:
-            self._handleVNCAuth(self.__recv(16))
+            yield from self._handleVNCAuth((yield 16))
         else:
             self.__close()
             raise RFBUnexpectedResponse(f"Unknown auth response {auth}")
 
     def _doClientInit(self):
         shared = 1 if self.sharedConn else 0
-        self.__send(es.return_uint8_bytes(shared, True))
-        self._handleServerInit(self.__recv(24))
+        self._send(s.pack("!B", shared))
+        yield from self._handleServerInit((yield 24))
 
     def _handleServerInit(self, data: bytes):
         try:
@@ -188,31 +1460,49 @@ class RFBClient:
             self.__close()
             raise RFBHandshakeFailed(e)
 
-        self.desktopname = self.__recv(namelen).decode()
+        self.desktopname = (yield namelen).decode()
         self.log.debug(f"Connecting to \"{self.desktopname}\"")
 
+        for decoder in self.decoders.values():
+            decoder.reset()
+
+        self._supportsContinuousUpdates = False
+        self._continuousUpdatesActive = False
+        self._continuousUpdatesSuspended = False
+        self._supportsFence = False
+        self._fenceSentAt = None
+
+        self._preferredEncoding = None
+        self._pendingPixelFormat = None
+        self._fullUpdateNeeded = False
+        self._requestsDue = 0
+        self._requestsInFlight = 0
+        self.__resetAdaptive()
+
+        self.colorMap = [0xff000000] * 256
+
         pixformatData = s.unpack("!BBBBHHHBBBxxx", pixformat)
         self.pixformat = RFBPixelformat(*pixformatData)
 
         self.log.debug(f"Server Pixelformat: {self.pixformat}")
         self.log.debug(f"Resolution: {self.vncWidth}x{self.vncHeight}")
 
+        self._allocFramebuffer()
+
         # not actually part of RTB proto, but some VNC servers (like QT QPA VNC)
         # require this to send FramebufferUpdate
-        self.setEncodings(SUPPORTED_ENCODINGS)
-
-        self.onConnectionMade()
+        # usually followed by SetPixelFormat in onConnectionMade
+        with self._sendBatch():
+            self.setEncodings(self.supportedEncodings())
+            self.onConnectionMade()
         self._connected = True
 
-        # enter main request loop
-        self._mainRequestLoop()
-
     def _handleVNCAuth(self, data: bytes):
         self._VNCAuthChallenge = data
 
         self.log.info("Requesting password")
         self.vncRequestPassword()
-        self._handleVNCAuthResult(self.__recv(4))
+        yield from self._handleVNCAuthResult((yield 4))
 
     def _handleVNCAuthResult(self, data: bytes):
         try:
@@ -222,10 +1512,10 @@ class RFBClient:
         self.log.debug(f"Auth result {result}")
 
         if result == c.SMSG_AUTH_OK:
-            self._doClientInit()
+            yield from self._doClientInit()
         elif result == c.SMSG_AUTH_FAIL:
             if self.version_min > 7:
-                self._handleVNCAuthError(self.__recv(4))
+                yield from self._handleVNCAuthError((yield 4))
             else:
                 raise VNCAuthentificationFailed("Authentication failed")
         elif result == c.SMSG_AUTH_TOOMANY:
@@ -235,12 +1525,12 @@ class RFBClient:
 
     def _handleVNCAuthError(self, data: bytes):
         waitfor = es.return_uint32_val(data)
-        raise VNCAuthentificationFailed(
-            f"Authentication failed ({self.__recv(waitfor)})")
+        reason = yield waitfor
+        raise VNCAuthentificationFailed(f"Authentication failed ({reason})")
 
     def _handleConnFailed(self, data: bytes):
         waitfor = es.return_uint32_val(data)
-        resp = self.__recv(waitfor)
+        resp = yield waitfor
 
         self.__close()
         raise RFBHandshakeFailed(resp)
@@ -251,22 +1541,30 @@ class RFBClient:
 
     def _mainRequestLoop(self):
         time.sleep(0.2)
-        # first request is non incremental
-        self.framebufferUpdateRequest(incremental=False)
+        self._requestInitialUpdates()
 
         while not self._stop and self.connection:
             try:
-                dType = self.__recv(1)
+                wait = self._sendDueRequests()
+                if not self._waitForData(wait):
+                    continue
+
+                dType = self._recv(1)
 
                 # when self.connection.close() is being called
                 # dType will be empty with length of 0
                 if len(dType) == 0:
+                    if self._writer.error:
+                        # sending failed, the writer shut the connection down
+                        self.onFatalError(self._writer.error)
+                        break
                     continue
 
                 start = time.time()
-                self._handleConnection(dType)
+                self._parse(self._handleConnection(dType))
 
-                self.log.debug(f"processing update took: {(time.time() - start)*1e3} ms")
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug(f"processing update took: {(time.time() - start)*1e3} ms")
             except socket.timeout:
                 self.log.debug("timeout triggered")
                 continue
@@ -276,14 +1574,49 @@ class RFBClient:
             except Exception as e:
                 self.onFatalError(e)
 
-            #print("AAA")
-            if self._requestFrameBufferUpdate:
-                self.framebufferUpdateRequest(
-                    incremental=self._incrementalFrameBufferUpdate)
-            #print("BBB")
-
         self.log.debug("loop exit")
 
+    def _waitForData(self, timeout: float = None) -> bool:
+        """
+        waits up to timeout seconds (None for no limit) for data from
+        the server, returns False if there was none or _wakeUp() was called
+        """
+        if self._recvEnd > self._recvStart:
+            return True
+        wakeup = self._wakeupSockets[0]
+        try:
+            ready = select.select([self.connection, wakeup], [], [], timeout)[0]
+            if wakeup in ready:
+                wakeup.recv(256)
+        except (OSError, ValueError):
+            # closed in the meantime, the next read notices
+            return True
+        return self.connection in ready
+
+    def _wakeUp(self):
+        """
+        interrupts _waitForData() of the main loop, which applies the
+        update region and pause state then. Called from other threads
+        """
+        sockets = self._wakeupSockets
+        if not sockets:
+            return
+        try:
+            sockets[1].send(b"\0")
+        except OSError:
+            # closed or already woken up often enough
+            pass
+
+    def _requestInitialUpdates(self):
+        self._applyControl()
+        if self._updatesPaused:
+            return
+        # first request is non incremental
+        with self._sendBatch():
+            self.framebufferUpdateRequest(*self._updateRect(), incremental=False)
+            self._requestsInFlight += 1
+            self._requestNextUpdates(self.requestWindow - 1)
+
     # ------------------------------------------------------------------
     ## Server -> Client messages
     # ------------------------------------------------------------------
@@ -293,82 +1626,434 @@ class RFBClient:
 
         if msgid == c.SMSG_FBUPDATE:
             # Framebuffer Update
-            self._handleFramebufferUpdate(self.__recv(3))
+            yield from self._handleFramebufferUpdate((yield 3))
         elif msgid == c.SMSG_BELL:
             # bell
             self.onBell()
         elif msgid == c.SMSG_SERVERCUTTEXT:
             # server cut text
-            self._handleServerCutText(self.__recv(7))
+            yield from self._handleServerCutText((yield 7))
         elif msgid == c.SMSG_SETCOLORMAP:
             # set color map entries
-            pass
+            yield from self._handleSetColorMap((yield 5))
+        elif msgid == c.SMSG_ENDOFCONTINUOUSUPDATES:
+            self._handleEndOfContinuousUpdates()
+        elif msgid == c.SMSG_SERVERFENCE:
+            yield from self._handleServerFence((yield 8))
         else:
             self.log.warning(f"Unknown message type recieved (id {msgid})")
             raise RFBUnexpectedResponse
 
     def _handleServerCutText(self, data: bytes):
         datalength = s.unpack("!xxxI", data)[0]
-        data = self.__recv(datalength)
+        data = yield datalength
 
         self.log.debug(f"Server clipboard: {data}")
         # TODO: create callback
 
+    def _handleSetColorMap(self, data: bytes):
+        first, count = s.unpack("!xHH", data)
+        entries = yield count * 6
+        self.log.debug(f"Color map entries {first} - {first + count - 1}")
+
+        if first + count > len(self.colorMap):
+            self.colorMap += [0xff000000] * (first + count - len(self.colorMap))
+
+        # 16 bit per channel, only the upper 8 bits are kept
+        self.colorMap[first:first + count] = [
+            0xff000000 | (r >> 8) << 16 | (g >> 8) << 8 | b >> 8
+            for r, g, b in s.iter_unpack("!HHH", entries)
+        ]
+        self.onColorMapChanged(first, count)
+
     def _handleFramebufferUpdate(self, data: bytes):
         numRectangles = s.unpack("!xH", data)[0]
-        self.log.debug(f"numRectangles: {numRectangles}")
+        if self._requestsInFlight:
+            self._requestsInFlight -= 1
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"numRectangles: {numRectangles}")
+
+        # with a window the replacement for the request this update
+        # answered is sent right away, so the server can work on it
+        # while this one is decoded
+        if self.requestWindow > 1:
+            self._scheduleNextUpdate()
 
         self.onBeginUpdate()
+        received, waited = self._bytesReceived, self._recvWaited
 
         for _ in range(numRectangles):
-            self._handleRectangle(self.__recv(12))
+            yield from self._handleRectangle((yield 12))
 
+        yield from self._waitDeferred()
+        self._flushDeferred()
         self.onFramebufferUpdateFinished()
 
-    def _handleRectangle(self, data: bytes):
-        xPos, yPos, width, height, encoding = s.unpack("!HHHHI", data)
+        if self.adaptiveEncoding:
+            self._adaptToThroughput(
+                self._bytesReceived - received, self._recvWaited - waited)
 
-        rect = RFBRectangle(xPos, yPos, width, height)
-        self.log.debug(f"RECT: {rect}")
+        if self._continuousUpdatesActive:
+            self._measureInFlight()
+        elif self._continuousUpdatesSuspended and not self._updatesPaused:
+            # backlog is gone, let the server push again
+            self._continuousUpdatesSuspended = False
+            self.enableContinuousUpdates(True, *self._updateRect())
+
+        if self.requestWindow == 1:
+            self._scheduleNextUpdate()
+
+    def _requestWait(self) -> float:
+        """
+        seconds until the next update may be requested according to maxFps
+        """
+        if not self.maxFps or self._continuousUpdatesActive:
+            return 0.0
+        return self._lastRequestAt + 1 / self.maxFps - time.monotonic()
+
+    def _scheduleNextUpdate(self):
+        """
+        requests the next update, or leaves it to the main loop
+        if maxFps does not allow it yet
+        """
+        if self._requestsDue or self._requestWait() > 0:
+            self._requestsDue += 1
+            return
+        self._lastRequestAt = time.monotonic()
+        self._requestNextUpdates()
 
-        if encoding == c.ENC_RAW:
-            size = (width*height*self.pixformat.bitspp) // 8
-            self.log.debug(f"expected size: {size}")
+    def _sendDueRequests(self) -> float:
+        """
+        sends a request held back by maxFps once it is due, called from
+        the main loop between messages. Returns the seconds until the
+        next one or None if there is none
+        """
+        self._applyControl()
+        if not self._requestsDue:
+            return None
+        wait = self._requestWait()
+        if wait > 0:
+            return wait
+
+        self._requestsDue -= 1
+        self._lastRequestAt = time.monotonic()
+        self._requestNextUpdates()
+        return self._requestWait() if self._requestsDue else None
+
+    def _requestNextUpdates(self, count: int = 1):
+        # the server pushes updates on its own while continuous updates are on
+        if not self._requestFrameBufferUpdate or self._continuousUpdatesActive \
+                or self._updatesPaused:
+            return
+        region = self._updateRect()
+        self._requestsInFlight += max(0, count)
+        with self._sendBatch():
+            if self._fullUpdateNeeded and count > 0:
+                self._fullUpdateNeeded = False
+                self.framebufferUpdateRequest(*region, incremental=False)
+                count -= 1
+            for _ in range(count):
+                self.framebufferUpdateRequest(
+                    *region, incremental=self._incrementalFrameBufferUpdate)
+
+    def _fillRequestWindow(self):
+        """
+        requests as many updates as are missing in the request window
+        """
+        self._requestNextUpdates(
+            self.requestWindow - self._requestsInFlight - self._requestsDue)
 
-            start = time.time()
-            data = self.__recv(expectedSize=size)
-            self.log.debug(f"fetching data took: {(time.time() - start)*1e3} ms")
+    def _updateRect(self) -> tuple:
+        """
+        updateRegion limited to the current screen size
+        """
+        if self.updateRegion is None:
+            return (0, 0, self.vncWidth, self.vncHeight)
+
+        xPos, yPos, width, height = self.updateRegion
+        xPos, yPos = min(xPos, self.vncWidth - 1), min(yPos, self.vncHeight - 1)
+        return (xPos, yPos,
+                max(1, min(width, self.vncWidth - xPos)),
+                max(1, min(height, self.vncHeight - yPos)))
+
+    def _handleEndOfContinuousUpdates(self):
+        if self._continuousUpdatesActive:
+            # server confirmed that continuous updates are off
+            self._continuousUpdatesActive = False
+            self._fillRequestWindow()
+            return
+        if self._supportsContinuousUpdates:
+            return
+
+        # first one is sent to announce support for the extension
+        self.log.debug("Server supports ContinuousUpdates")
+        self._supportsContinuousUpdates = True
+        if not self._requestFrameBufferUpdate:
+            return
+        if self._updatesPaused:
+            self._continuousUpdatesSuspended = True
+        else:
+            self.enableContinuousUpdates(True, *self._updateRect())
+
+    def _handleServerFence(self, data: bytes):
+        flags, length = s.unpack("!xxxIB", data)
+        payload = yield length
+        self._supportsFence = True
+
+        if flags & c.FENCE_REQUEST:
+            # messages are handled strictly in order, so the blocking
+            # requirements are met by answering right away
+            self.fence(flags & (c.FENCE_BLOCK_BEFORE | c.FENCE_BLOCK_AFTER), payload)
+        elif payload == FLOW_CONTROL_FENCE:
+            self._handleFlowControlFence()
+        elif payload == PIXEL_FORMAT_FENCE and self._pendingPixelFormat:
+            pixformat, self._pendingPixelFormat = self._pendingPixelFormat, None
+            yield from self._waitDeferred()
+            # everything from here on is in the new format
+            self._switchPixelFormat(pixformat)
+            if self._continuousUpdatesActive and not self._updatesPaused:
+                # the server pushes updates regardless of requests
+                self.framebufferUpdateRequest(*self._updateRect(), incremental=False)
+            else:
+                # goes out with the next request, or after resuming
+                self._fullUpdateNeeded = True
 
-            self._decodeRAW(data, rect)
-            del data
+    def _measureInFlight(self):
+        """
+        a fence sent after an update comes back behind everything the
+        server pushed in the meantime, which tells how far behind we are
+        """
+        if not self._supportsFence or self._fenceSentAt is not None:
+            return
+        self._fenceSentAt = self._bytesReceived
+        self.fence(c.FENCE_REQUEST | c.FENCE_BLOCK_BEFORE, FLOW_CONTROL_FENCE)
+
+    def _handleFlowControlFence(self):
+        if self._fenceSentAt is None:
+            return
+        inFlight = self._bytesReceived - self._fenceSentAt
+        self._fenceSentAt = None
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"in flight: {inFlight//1024} KB")
+
+        if inFlight > MAX_IN_FLIGHT and self._continuousUpdatesActive:
+            # fall back to one update at a time until we caught up
+            self.log.debug("Throttling continuous updates")
+            self._continuousUpdatesSuspended = True
+            self.enableContinuousUpdates(False)
+
+    def _adaptToThroughput(self, size: int, seconds: float):
+        if not self._throughput.addSample(size, seconds):
+            return
+        kbps = self._throughput.kbps
+
+        def fastest(margin: float) -> int:
+            return max(i for i, profile in enumerate(ADAPTIVE_PROFILES)
+                       if kbps >= profile.minKbps * margin)
+
+        current = self._profile
+        target = fastest(1.0)
+        if current is not None:
+            # in between the two thresholds the current profile stays
+            if fastest(ADAPT_UP_MARGIN) > current:
+                target = fastest(ADAPT_UP_MARGIN)
+            elif target > current:
+                target = current
+
+        if target == self._profileCandidate:
+            self._profileVotes += 1
         else:
+            self._profileCandidate, self._profileVotes = target, 1
+
+        if target == current or self._profileVotes < ADAPT_SAMPLES \
+                or time.monotonic() - self._profileSwitchedAt < ADAPT_INTERVAL:
+            return
+
+        self.log.info(f"Throughput {kbps:.0f} kbit/s, "
+                      f"switching to profile {ADAPTIVE_PROFILES[target].name}")
+        self._profile = target
+        self._profileSwitchedAt = time.monotonic()
+        self._applyProfile(ADAPTIVE_PROFILES[target])
+
+    def _applyProfile(self, profile: AdaptiveProfile):
+        self._preferredEncoding = profile.encoding
+        self.jpegQuality = profile.jpegQuality
+        self.compressLevel = profile.compressLevel
+
+        if self._fullPixelFormat is None:
+            self._fullPixelFormat = self.pixformat
+        pixformat = self._fullPixelFormat
+        if profile.lowColor and pixformat.bitspp > 16:
+            pixformat = RFBPixelformat.getRGB16()
+
+        with self._sendBatch():
+            self.setEncodings(self.supportedEncodings())
+            if pixformat.asTuple() != self.pixformat.asTuple():
+                self._requestPixelFormat(pixformat)
+
+    def _requestPixelFormat(self, pixelformat: RFBPixelformat):
+        """
+        changes the pixel format while updates are coming in,
+        the screen is requested again in the new format afterwards
+        """
+        if self._pendingPixelFormat is not None:
+            return
+
+        if self._supportsFence:
+            # the server answers the fence after the last update in the
+            # old format and applies the pixel format right after it
+            self._pendingPixelFormat = pixelformat
+            with self._sendBatch():
+                self.fence(c.FENCE_REQUEST | c.FENCE_BLOCK_BEFORE | c.FENCE_SYNC_NEXT,
+                           PIXEL_FORMAT_FENCE)
+                self._sendPixelFormat(pixelformat)
+        elif not self._requestsInFlight and not self._continuousUpdatesActive:
+            # called between two updates, none is on its way
+            self._sendPixelFormat(pixelformat)
+            self._switchPixelFormat(pixelformat)
+            self._fullUpdateNeeded = True
+        else:
+            self.log.debug("Can't tell which updates use the new pixel format, "
+                           "keeping the current one")
+
+    def _switchPixelFormat(self, pixelformat: RFBPixelformat):
+        # everything pending is still in the old format
+        self._flushDeferred()
+
+        self.pixformat = pixelformat
+        self._allocFramebuffer()
+        self.onPixelFormatChanged()
+
+    def _handleRectangle(self, data: bytes):
+        xPos, yPos, width, height, encoding = s.unpack("!HHHHi", data)
+
+        rect = RFBRectangle(xPos, yPos, width, height)
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug(f"RECT: {rect}")
+
+        decoder = self.decoders.get(encoding)
+        if not decoder:
             raise TypeError(f"Unsupported encoding received ({encoding})")
 
+        # deferred rectangles underneath have to land first,
+        # pseudo-encodings do not cover any screen area
+        if encoding >= 0:
+            yield from self._waitDeferred(rect)
+            self._flushDeferred(rect)
+
+        start = time.time()
+        parser = decoder.decode(self, rect)
+        if parser is not None:
+            yield from parser
+        if debug:
+            self.log.debug(f"decoding took: {(time.time() - start)*1e3} ms")
 
     # ------------------------------------------------------------------
     ## Image decoding stuff
     # ------------------------------------------------------------------        
 
-    def _decodeRAW(self, data: bytes, rectangle: RFBRectangle):
-        self.onRectangleUpdate(*rectangle.asTuple(), data)
+    def _allocFramebuffer(self):
+        self.framebuffer = RFBFramebuffer(
+            self.vncWidth, self.vncHeight, self.pixformat.bytespp)
+        self.log.debug(f"Framebuffer: {self.framebuffer}")
+
+    def _resizeFramebuffer(self, width: int, height: int):
+        self.log.debug(f"Remote desktop resized to {width}x{height}")
+
+        # everything pending belongs to the old framebuffer
+        self._flushDeferred()
+
+        self.vncWidth, self.vncHeight = width, height
+        self.framebuffer = self.framebuffer.resized(width, height)
+        self.onDesktopResize(width, height)
+
+        if self._continuousUpdatesActive:
+            # the region to update was limited to the old screen
+            self.enableContinuousUpdates(True, *self._updateRect())
+
+    def _deferRectangle(self, rectangle: RFBRectangle, result: Future):
+        """
+        used by decoders which decode in the background, result has to
+        resolve to the pixel data of the rectangle
+        """
+        self._deferredRects.append((rectangle, result))
+
+    def _needsFlush(self, rectangle: RFBRectangle = None) -> bool:
+        if not self._deferredRects:
+            return False
+        return rectangle is None or any(
+            rectangle.intersects(pending) for pending, _ in self._deferredRects)
+
+    def _waitDeferred(self, rectangle: RFBRectangle = None):
+        """
+        parser step waiting for the results _flushDeferred() is going
+        to write, so it does not block the event loop of AsyncRFBClient
+        """
+        if not self._needsFlush(rectangle):
+            return
+        for _, result in self._deferredRects:
+            if not result.done():
+                yield result
+
+    def _flushDeferred(self, rectangle: RFBRectangle = None):
+        """
+        writes pending results of deferred rectangles to the framebuffer,
+        if a rectangle is given only when it overlaps any of them
+        """
+        if not self._needsFlush(rectangle):
+            return
+
+        pending, self._deferredRects = self._deferredRects, list()
+
+        for rect, result in pending:
+            self.framebuffer.putRect(*rect.asTuple(), result.result())
+            self.onFramebufferChanged(*rect.asTuple())
 
     # ------------------------------------------------------------------
     ## Client -> Server messages
     # ------------------------------------------------------------------
 
     def setPixelFormat(self, pixelformat: RFBPixelformat):
-        self.log.debug(f"Requesting pixelformat: {pixelformat}")
+        """
+        only safe while no updates are on their way,
+        like in onConnectionMade()
+        """
+        self._sendPixelFormat(pixelformat)
 
         self.pixformat = pixelformat
+        self._allocFramebuffer()
+
+    def _sendPixelFormat(self, pixelformat: RFBPixelformat):
+        self.log.debug(f"Requesting pixelformat: {pixelformat}")
+
         pformat = s.pack("!BBBBHHHBBBxxx", *pixelformat.asTuple())
-        self.__send(s.pack("!Bxxx16s", c.CMSG_SETPIXELFORMAT, pformat))
+        self._send(s.pack("!Bxxx16s", c.CMSG_SETPIXELFORMAT, pformat))
 
     def setEncodings(self, encodings: list):
         self.log.debug(f"Requesting encodings: {encodings}")
 
-        self.__send(s.pack("!BxH", c.CMSG_SETENCODINGS, len(encodings)))
-        for encoding in encodings:
-            self.__send(es.return_sint32_bytes(encoding, True))
+        self._send(s.pack(f"!BxH{len(encodings)}i",
+                          c.CMSG_SETENCODINGS, len(encodings), *encodings))
+
+    def supportedEncodings(self) -> list:
+        """
+        encodings of all registered decoders in priority order (the one
+        preferred by adaptiveEncoding first), followed by the requested
+        pseudo-encodings
+        """
+        encodings = list(self.decoders)
+        if self._preferredEncoding in self.decoders:
+            encodings.remove(self._preferredEncoding)
+            encodings.insert(0, self._preferredEncoding)
+
+        if self.jpegQuality is not None:
+            encodings.append(c.ENC_QUALITY_LEVEL_0 + self.jpegQuality)
+        if self.compressLevel is not None:
+            encodings.append(c.ENC_COMPRESS_LEVEL_0 + self.compressLevel)
+        if self.continuousUpdates:
+            encodings += [c.ENC_FENCE, c.ENC_CONTINUOUS_UPDATES]
+        return encodings
 
     def framebufferUpdateRequest(self,
             xPos=0, yPos=0,
@@ -379,19 +2064,132 @@ class RFBClient:
         if not height: height = self.vncHeight - yPos
         inc = 1 if incremental else 0
 
-        self.__send(s.pack(
+        self._send(s.pack(
             "!BBHHHH",
             c.CMSG_FBUPDATEREQ, inc,
             xPos, yPos, width, height))
 
+    def enableContinuousUpdates(self, enable=True,
+            xPos=0, yPos=0,
+            width=None, height=None):
+        """
+        only available after the server announced support for it,
+        disabling takes effect once the server confirmed it
+        """
+        if not self._supportsContinuousUpdates:
+            return
+
+        if not width: width = self.vncWidth - xPos
+        if not height: height = self.vncHeight - yPos
+
+        self._send(s.pack(
+            "!BBHHHH",
+            c.CMSG_ENABLECONTINUOUSUPDATES, 1 if enable else 0,
+            xPos, yPos, width, height))
+
+        if enable:
+            self._continuousUpdatesActive = True
+
+    def setUpdateRegion(self, xPos: int = 0, yPos: int = 0,
+            width: int = None, height: int = None):
+        """
+        only requests updates of the given part of the remote screen,
+        without a size the whole screen is requested again.
+        Areas which were not part of the region before are requested
+        in full once.
+
+        can be called from any thread, the RFB thread applies it
+        between two messages
+        """
+        with self._controlLock:
+            if width is None or height is None:
+                self._requestedRegion = None
+            else:
+                self._requestedRegion = (xPos, yPos, width, height)
+        self._wakeUp()
+
+    def pauseUpdates(self):
+        """
+        stops requesting updates until resumeUpdates() is called,
+        e.g. while nothing of the remote screen is visible.
+        Can be called from any thread like setUpdateRegion()
+        """
+        with self._controlLock:
+            self._requestedPause = True
+        self._wakeUp()
+
+    def resumeUpdates(self):
+        with self._controlLock:
+            self._requestedPause = False
+        self._wakeUp()
+
+    def _applyControl(self):
+        """
+        applies what setUpdateRegion(), pauseUpdates() and resumeUpdates()
+        requested, only called from the RFB thread
+        """
+        with self._controlLock:
+            region, paused = self._requestedRegion, self._requestedPause
+
+        # a new region is only recorded while paused
+        if paused and not self._updatesPaused:
+            self._pauseUpdates()
+        if region != self.updateRegion:
+            self._changeUpdateRegion(region)
+        if not paused and self._updatesPaused:
+            self._resumeUpdates()
+
+    def _changeUpdateRegion(self, updateRegion: tuple):
+        previous = self._updateRect()
+        self.updateRegion = updateRegion
+
+        region = self._updateRect()
+        if not self._connected or self._updatesPaused or region == previous:
+            return
+
+        px, py, pw, ph = previous
+        x, y, w, h = region
+        exposed = x < px or y < py or x + w > px + pw or y + h > py + ph
+
+        if self._continuousUpdatesActive:
+            self.enableContinuousUpdates(True, *region)
+            if exposed:
+                self.framebufferUpdateRequest(*region, incremental=False)
+        elif exposed:
+            # goes out with the next request
+            self._fullUpdateNeeded = True
+
+    def _pauseUpdates(self):
+        self._updatesPaused = True
+        self.log.debug("Updates paused")
+
+        if self._continuousUpdatesActive:
+            self._continuousUpdatesSuspended = True
+            self.enableContinuousUpdates(False)
+
+    def _resumeUpdates(self):
+        self._updatesPaused = False
+        self.log.debug("Updates resumed")
+
+        # the screen went on changing in the meantime
+        self._fullUpdateNeeded = True
+        if self._connected and not self._continuousUpdatesActive:
+            # continuous updates are turned on again after the first one,
+            # requests sent before pausing may still be on their way
+            self._fillRequestWindow()
+
+    def fence(self, flags: int, payload: bytes = b""):
+        self._send(s.pack("!BxxxIB", c.CMSG_CLIENTFENCE, flags, len(payload)) + payload)
+
     def keyEvent(self, key, down=1):
         """
         For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants
         """
-        self.log.debug(f'keyEvent: {key}, {"down" if down else "up"}')
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f'keyEvent: {key}, {"down" if down else "up"}')
 
-        self.__send(s.pack("!BBxxI", c.CMSG_KEYEVENT, down, key))
+        self._send(s.pack("!BBxxI", c.CMSG_KEYEVENT, down, key))
 
     def pointerEvent(self, x: int, y: int, buttommask=0):
         """
@@ -401,8 +2199,11 @@ class RFBClient:
         """
         if not self._connected: return
 
-        self.log.debug(f"pointerEvent: {x}, {y}, {buttommask}")
-        self.__send(s.pack("!BBHH", c.CMSG_POINTEREVENT, buttommask, x, y))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"pointerEvent: {x}, {y}, {buttommask}")
+        # motion still queued is replaced, button changes are kept
+        self._send(s.pack("!BBHH", c.CMSG_POINTEREVENT, buttommask, x, y),
+                   mergeKey=(c.CMSG_POINTEREVENT, buttommask))
 
     # ------------------------------------------------------------------
     ## Direct Calls
@@ -417,7 +2218,36 @@ class RFBClient:
             password = password.encode("ascii")
         password = (password + bytes(8))[:8]
         des = RFBDes(password)
-        self.__send(des.encrypt(self._VNCAuthChallenge))
+        self._send(des.encrypt(self._VNCAuthChallenge))
+
+    def registerDecoder(self, decoder: RFBDecoder, priority: int = None):
+        """
+        registers decoder for decoder.encoding, replacing any previous one.
+        priority is the position in the list of encodings sent to the server
+        (0 is the most preferred one), None appends it to the end.
+
+        when connected the new list of encodings is sent right away
+        """
+        previous = self.decoders.get(decoder.encoding)
+        if previous and previous is not decoder:
+            previous.close()
+
+        decoders = [d for d in self.decoders.values() if d.encoding != decoder.encoding]
+        if priority is None:
+            priority = len(decoders)
+        decoders.insert(priority, decoder)
+
+        self.decoders = {d.encoding: d for d in decoders}
+        if self._connected:
+            decoder.reset()
+            self.setEncodings(self.supportedEncodings())
+
+    def unregisterDecoder(self, encoding: int):
+        decoder = self.decoders.pop(encoding, None)
+        if decoder:
+            decoder.close()
+        if self._connected:
+            self.setEncodings(self.supportedEncodings())
 
     def reconnect(self):
         self.closeConnection()
@@ -432,6 +2262,10 @@ class RFBClient:
             self.log.debug("waiting for main loop to exit")
             self._mainLoop.join()
 
+        for decoder in self.decoders.values():
+            decoder.close()
+        self._deferredRects.clear()
+
     # ------------------------------------------------------------------
     ## Callbacks
     # ------------------------------------------------------------------
@@ -443,20 +2277,61 @@ class RFBClient:
 
         setPixelFormat() and setEncodings()
 
+        self.framebuffer is (re)allocated by setPixelFormat()
+
         the RFB main update loop will start after this function is done
         """
 
+    def onDesktopResize(self, width: int, height: int):
+        """
+        the remote desktop changed its size, self.framebuffer has been
+        replaced by one of the new size containing what still fits
+        """
+
+    def onPixelFormatChanged(self):
+        """
+        adaptiveEncoding switched to another pixel format, self.framebuffer
+        has been replaced by an empty one in the new format and the whole
+        screen has been requested again
+        """
+
+    def onColorMapChanged(self, first: int, count: int):
+        """
+        the server changed count entries of self.colorMap starting at
+        first, pixels of formats without truecolor are indices into it
+        """
+
     def onBeginUpdate(self):
         """
         called before a series of updateRectangle(),
         copyRectangle() or fillRectangle().
         """
 
-    def onRectangleUpdate(self,
-            x: int, y: int, width: int, height: int, data: bytes):
+    def onFramebufferChanged(self,
+            x: int, y: int, width: int, height: int):
+        """
+        new bitmap data has been written into the given area of
+        self.framebuffer, in the pixel format set up earlier.
         """
-        new bitmap data. data are bytes in the pixel format set
-        up earlier.
+
+    def onCopyRectangle(self,
+            srcx: int, srcy: int, x: int, y: int, width: int, height: int):
+        """
+        the area at srcx, srcy with the given size has been copied to
+        x, y in self.framebuffer, onFramebufferChanged() has been called
+        for it as well. Both areas can overlap.
+        """
+
+    def onCursorUpdate(self,
+            hotX: int, hotY: int, width: int, height: int,
+            pixels: bytes, mask: bytes):
+        """
+        the server changed the cursor shape, the pointer has to be drawn
+        locally. pixels are in the current pixel format, mask has one bit
+        per pixel (most significant first, rows padded to full bytes),
+        set bits are visible. A size of 0 hides the cursor.
+
+        only called with a CursorDecoder registered
         """
 
     def onFramebufferUpdateFinished(self):
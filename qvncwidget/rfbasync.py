@@ -0,0 +1,245 @@
+"""
+RFB protocol implementation on asyncio, client side
+
+(c) zocker-160 2024
+licensed under GPLv3
+"""
+
+from qvncwidget.rfb import RFBClient, RFBNoResponse, RECV_BUFF_SIZE
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+import asyncio
+import logging
+import socket
+import struct as s
+import time
+
+class AsyncRFBClient(RFBClient):
+    """
+    RFBClient running on an asyncio event loop instead of a thread of its
+    own, for many connections in one process. Message parsing, decoding
+    and the callbacks are the ones of RFBClient, see RFBClient._parse().
+
+    Callbacks are called from the event loop and all methods have to be
+    called from it as well.
+
+        client = MyClient("127.0.0.1", 5900, password="1234")
+        await client.run()
+    """
+
+    log = logging.getLogger("RFB Async Client")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection = None
+
+        self._reader: asyncio.StreamReader = None
+        self._streamWriter: asyncio.StreamWriter = None
+        self._task: asyncio.Task = None
+        self._batch: list = None
+
+        # read ahead buffer, data from _readStart on is pending
+        self._readBuffer = bytearray()
+        self._readStart = 0
+
+    async def run(self):
+        """
+        connects, does the handshake and handles server messages
+        until closeConnection() is called
+        """
+        self._stop = False
+        self._readBuffer = bytearray()
+        self._readStart = 0
+        self._bytesReceived = 0
+        self._recvWaited = 0.0
+
+        await self._open()
+        try:
+            await self._parseAsync(self._handleInitial())
+
+            if self._connected:
+                await asyncio.sleep(0.2)
+                self._requestInitialUpdates()
+                await self._mainLoopAsync()
+        except RFBNoResponse:
+            if not self._stop:
+                raise
+        finally:
+            self._closeStream()
+
+    async def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._configureSocket(sock)
+        sock.setblocking(False)
+
+        try:
+            await asyncio.wait_for(
+                asyncio.get_running_loop().sock_connect(sock, (self.host, self.port)),
+                self.connectTimeout)
+            self._reader, self._streamWriter = \
+                await asyncio.open_connection(sock=sock, limit=RECV_BUFF_SIZE)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _closeStream(self):
+        if self._streamWriter:
+            self._streamWriter.close()
+        self._reader = self._streamWriter = None
+
+    async def _mainLoopAsync(self):
+        while not self._stop:
+            try:
+                wait = self._sendDueRequests()
+                if wait is not None and not await self._waitForData(wait):
+                    continue
+
+                dType = await self._read(1)
+
+                start = time.time()
+                await self._parseAsync(self._handleConnection(dType))
+
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug(f"processing update took: {(time.time() - start)*1e3} ms")
+            except RFBNoResponse as e:
+                # nothing left to handle
+                if not self._stop:
+                    self.onFatalError(e)
+                break
+            except s.error as e:
+                self.log.exception(str(e))
+                continue
+            except Exception as e:
+                self.onFatalError(e)
+
+        self.log.debug("loop exit")
+
+    # ------------------------------------------------------------------
+    ## Reading and writing
+    # ------------------------------------------------------------------
+
+    async def _parseAsync(self, parser):
+        """
+        runs a parser generator like RFBClient._parse(), but waits for
+        data on the event loop
+        """
+        try:
+            request = next(parser)
+            while True:
+                if type(request) is int:
+                    if len(self._readBuffer) - self._readStart < request:
+                        await self._fillReadBuffer(request)
+                    request = parser.send(self._take(request))
+                elif isinstance(request, Future):
+                    # JPEG rectangles are decoded on the shared worker pool
+                    await asyncio.wait((asyncio.wrap_future(request),))
+                    request = next(parser)
+                else:
+                    request[:] = await self._read(len(request))
+                    request = next(parser)
+        except StopIteration as e:
+            return e.value
+
+    async def _waitForData(self, timeout: float) -> bool:
+        if len(self._readBuffer) > self._readStart:
+            return True
+        try:
+            await asyncio.wait_for(self._fillReadBuffer(1), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _wakeUp(self):
+        # everything runs on the event loop, so there is nothing to wait for
+        self._applyControl()
+
+    async def _read(self, size: int) -> bytes:
+        if len(self._readBuffer) - self._readStart < size:
+            await self._fillReadBuffer(size)
+        return self._take(size)
+
+    def _take(self, size: int) -> bytes:
+        """
+        returns size bytes from the read ahead buffer, which have to be
+        there already. Most reads are served from it without waiting
+        """
+        start = self._readStart
+        self._readStart += size
+        with memoryview(self._readBuffer) as view:
+            data = bytes(view[start:start + size])
+
+        if self.logs.isEnabledFor(logging.DEBUG):
+            if size <= 50:
+                self.logs.debug(f"len: {size} | {data.hex()}")
+            else:
+                self.logs.debug(f"{size} Bytes | {size//1024} KB")
+
+        return data
+
+    async def _fillReadBuffer(self, size: int):
+        # drop what has been read already
+        del self._readBuffer[:self._readStart]
+        self._readStart = 0
+
+        while len(self._readBuffer) < size:
+            if not self._reader:
+                raise RFBNoResponse("Connection closed while receiving data")
+
+            waitStart = time.perf_counter()
+            data = await self._reader.read(max(RECV_BUFF_SIZE, size - len(self._readBuffer)))
+            self._recvWaited += time.perf_counter() - waitStart
+            if not data:
+                raise RFBNoResponse("Connection closed while receiving data")
+
+            self._readBuffer += data
+            self._bytesReceived += len(data)
+
+    def _send(self, data: bytes, mergeKey = None):
+        """
+        hands data to the transport, which buffers what the socket does
+        not take right away. Nothing is queued here, so mergeKey is not
+        used
+        """
+        if self._batch is not None:
+            self._batch.append(data)
+        elif self._streamWriter and not self._streamWriter.is_closing():
+            self._streamWriter.write(data)
+
+        if self.logc.isEnabledFor(logging.DEBUG):
+            self.logc.debug(data.hex())
+
+    @contextmanager
+    def _sendBatch(self):
+        if self._batch is not None:
+            # already inside of a batch
+            yield
+            return
+
+        self._batch = list()
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            if batch and self._streamWriter and not self._streamWriter.is_closing():
+                self._streamWriter.write(b"".join(batch))
+
+    # ------------------------------------------------------------------
+    ## Direct Calls
+    # ------------------------------------------------------------------
+
+    def startConnection(self):
+        """
+        runs run() as a task on the running event loop
+        """
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def closeConnection(self):
+        super().closeConnection()
+        self._closeStream()
+
+        # the task exits on its own when the connection is closed from
+        # inside of it (e.g. in a callback)
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
@@ -10,9 +10,32 @@ ENC_HEXTILE  = 5  # Hextile
 ENC_TRLE     = 15 # TRLE
 ENC_ZRLE     = 16 # ZRLE
 
+# Hextile subencoding flags
+HEXTILE_RAW               = 1
+HEXTILE_BACKGROUND        = 2
+HEXTILE_FOREGROUND        = 4
+HEXTILE_ANY_SUBRECTS      = 8
+HEXTILE_SUBRECTS_COLOURED = 16
+HEXTILE_ZLIB_RAW          = 32 # ZlibHex only
+HEXTILE_ZLIB_HEX          = 64 # ZlibHex only
+
+# Tight compression control (upper 4 bits) and filter types
+TIGHT_FILL     = 8
+TIGHT_JPEG     = 9
+TIGHT_EXPLICIT_FILTER = 4
+TIGHT_FILTER_COPY     = 0
+TIGHT_FILTER_PALETTE  = 1
+TIGHT_FILTER_GRADIENT = 2
+TIGHT_MIN_TO_COMPRESS = 12
+
 # pseudo-encodings
 ENC_CURSOR      = -239 # Cursor position pseudo-encoding
 ENC_DESKTOPSIZE = -223 # DesktopSize pseudo-encoding
+ENC_EXTENDED_DESKTOPSIZE = -308 # ExtendedDesktopSize pseudo-encoding
+ENC_QUALITY_LEVEL_0  = -32  # JPEG Quality Level pseudo-encoding (0 - 9)
+ENC_COMPRESS_LEVEL_0 = -256 # Compression Level pseudo-encoding (0 - 9)
+ENC_FENCE              = -312 # Fence pseudo-encoding
+ENC_CONTINUOUS_UPDATES = -313 # ContinuousUpdates pseudo-encoding
 
 # additional
 ENC_CORRE   = 4
@@ -154,6 +177,8 @@ SMSG_FBUPDATE = 		0
 SMSG_SETCOLORMAP = 		1
 SMSG_BELL = 			2
 SMSG_SERVERCUTTEXT = 	3
+SMSG_ENDOFCONTINUOUSUPDATES = 150
+SMSG_SERVERFENCE =		248
 
 
 # Client message types
@@ -163,3 +188,11 @@ CMSG_FBUPDATEREQ = 		3
 CMSG_KEYEVENT =			4
 CMSG_POINTEREVENT =		5
 CMSG_CLIENTCUTTEXT =	6
+CMSG_ENABLECONTINUOUSUPDATES = 150
+CMSG_CLIENTFENCE =		248
+
+# Fence flags
+FENCE_BLOCK_BEFORE = 1 << 0
+FENCE_BLOCK_AFTER  = 1 << 1
+FENCE_SYNC_NEXT    = 1 << 2
+FENCE_REQUEST      = 1 << 31
@@ -1,10 +1,37 @@
 
 import logging
+import sys
+import struct as s
 import qvncwidget.rfbconstants as c
 
-from PyQt5.QtGui import QMouseEvent
+from array import array
+from threading import Lock
+
+from PyQt5.QtGui import QImage, QMouseEvent
 from PyQt5.QtCore import Qt
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOST_BIGENDIAN = sys.byteorder == "big"
+
+# 16 bit formats Qt stores as native endian 16 bit integers,
+# (redmax, greenmax, bluemax, redshift, greenshift, blueshift)
+_QIMAGE_FORMATS_16 = {
+    (31, 63, 31, 11, 5, 0): QImage.Format.Format_RGB16,
+    (31, 31, 31, 10, 5, 0): QImage.Format.Format_RGB555,
+    (15, 15, 15, 8, 4, 0): QImage.Format.Format_RGB444,
+}
+
+# 32 bit formats with 8 bit channels, (red, green, blue) byte in memory.
+# Format_RGB32 is a native endian 0xffRRGGBB integer.
+_QIMAGE_FORMATS_32 = {
+    (1, 2, 3) if HOST_BIGENDIAN else (2, 1, 0): QImage.Format.Format_RGB32,
+    (0, 1, 2): QImage.Format.Format_RGBX8888,
+}
+
 class RFBPixelformat:
     def __init__(self,
         bpp=32, depth=24, bigendian=False, truecolor=True,
@@ -62,6 +89,21 @@ class RFBPixelformat:
             redshift=8, greenshift=4, blueshift=0
         )
 
+    @staticmethod
+    def getIndexed8():
+        """
+        8 bit indices into a colour map set by the server
+        """
+        return RFBPixelformat(
+            bpp=8, depth=8, truecolor=False,
+            redmax=0, greenmax=0, bluemax=0,
+            redshift=0, greenshift=0, blueshift=0
+        )
+
+    @property
+    def bytespp(self) -> int:
+        return self.bitspp // 8
+
     def asTuple(self) -> tuple:
         return (
             self.bitspp, self.depth, self.bigendian, self.truecolor,
@@ -69,6 +111,52 @@ class RFBPixelformat:
             self.redshift, self.greenshift, self.blueshift
         )
 
+    def qimageFormat(self) -> QImage.Format:
+        """
+        QImage format with exactly the memory layout of this format,
+        so framebuffers can be displayed without converting them.
+        None if Qt has no such format.
+        """
+        if not self.truecolor:
+            return None
+
+        channels = (
+            self.redmax, self.greenmax, self.bluemax,
+            self.redshift, self.greenshift, self.blueshift
+        )
+        if self.bitspp == 16:
+            if bool(self.bigendian) != HOST_BIGENDIAN:
+                return None
+            return _QIMAGE_FORMATS_16.get(channels)
+
+        if self.bitspp == 32:
+            shifts = channels[3:]
+            if channels[:3] != (255, 255, 255) or any(shift % 8 for shift in shifts):
+                return None
+            if self.bigendian:
+                planes = tuple(3 - shift // 8 for shift in shifts)
+            else:
+                planes = tuple(shift // 8 for shift in shifts)
+            return _QIMAGE_FORMATS_32.get(planes)
+
+        # 8 bit formats would need Format_Indexed8 with a color table,
+        # but setting one makes Qt copy images it doesn't own
+        return None
+
+    def toRGB(self, pixel: int) -> int:
+        """
+        0xffRRGGBB value of a pixel value
+        """
+        def channel(shift: int, maximum: int) -> int:
+            if not maximum:
+                return 0
+            return ((pixel >> shift) & maximum) * 255 // maximum
+
+        return 0xff000000 \
+            | channel(self.redshift, self.redmax) << 16 \
+            | channel(self.greenshift, self.greenmax) << 8 \
+            | channel(self.blueshift, self.bluemax)
+
     def __str__(self) -> str:
         return ";".join(str(x) for x in self.asTuple())
 
@@ -82,9 +170,314 @@ class RFBRectangle:
     def asTuple(self) -> tuple:
         return (self.xPos, self.yPos, self.width, self.height)
 
+    def intersects(self, other: "RFBRectangle") -> bool:
+        return (self.xPos < other.xPos + other.width
+            and other.xPos < self.xPos + self.width
+            and self.yPos < other.yPos + other.height
+            and other.yPos < self.yPos + self.height)
+
     def __str__(self) -> str:
         return f"x: {self.xPos} y: {self.yPos} width: {self.width} height: {self.height}"
 
+class RFBFramebuffer:
+    """
+    Client side copy of the remote framebuffer in the requested pixel format.
+    All rows are stored back to back in a single bytearray, so decoders
+    can write into it in place and a QImage can be created on top of it.
+    """
+    def __init__(self, width: int, height: int, bytespp: int):
+        self.width = width
+        self.height = height
+        self.bytespp = bytespp
+        self.stride = width * bytespp
+
+        self.data = bytearray(self.stride * height)
+        self.view = memoryview(self.data)
+
+        # (height, width, bytespp) view on the same memory
+        self.array = None
+        if np is not None:
+            self.array = np.frombuffer(self.data, np.uint8).reshape(
+                height, width, bytespp)
+
+    def offset(self, xPos: int, yPos: int) -> int:
+        return yPos * self.stride + xPos * self.bytespp
+
+    def fill(self, xPos: int, yPos: int, width: int, height: int,
+            pixel: bytes):
+        """
+        fills a rectangle with a single pixel value
+        """
+        if self.array is not None:
+            self.array[yPos:yPos + height, xPos:xPos + width] = \
+                np.frombuffer(pixel, np.uint8)
+            return
+
+        rowSize = width * self.bytespp
+        line = bytes(pixel) * width
+        for row in range(yPos, yPos + height):
+            start = self.offset(xPos, row)
+            self.view[start:start + rowSize] = line
+
+    def putRect(self, xPos: int, yPos: int, width: int, height: int,
+            data):
+        """
+        writes a rectangle of tightly packed pixel rows into the framebuffer,
+        data can be any bytes-like object or a numpy array
+        """
+        if self.array is not None:
+            if not isinstance(data, np.ndarray):
+                data = np.frombuffer(data, np.uint8)
+            self.array[yPos:yPos + height, xPos:xPos + width] = \
+                data.reshape(height, width, self.bytespp)
+            return
+
+        data = memoryview(data).cast("B")
+        rowSize = width * self.bytespp
+        for row in range(height):
+            start = self.offset(xPos, yPos + row)
+            self.view[start:start + rowSize] = \
+                data[row*rowSize:(row + 1)*rowSize]
+
+    def copyRect(self, srcX: int, srcY: int,
+            xPos: int, yPos: int, width: int, height: int):
+        """
+        copies a rectangle inside the framebuffer, source and destination
+        are allowed to overlap
+        """
+        rowSize = width * self.bytespp
+        rows = range(height)
+
+        # when moving down, copy bottom up so no source row
+        # gets overwritten before it has been copied
+        if yPos > srcY:
+            rows = reversed(rows)
+
+        for row in rows:
+            src = self.offset(srcX, srcY + row)
+            dst = self.offset(xPos, yPos + row)
+            # memoryview assignment uses memmove, overlap within a row is fine
+            self.view[dst:dst + rowSize] = self.view[src:src + rowSize]
+
+    def blit(self, source: "RFBFramebuffer",
+            xPos: int, yPos: int, width: int, height: int):
+        """
+        copies a rectangle from another framebuffer of the same format
+        to the same position in this one
+        """
+        if self.array is not None:
+            self.array[yPos:yPos + height, xPos:xPos + width] = \
+                source.array[yPos:yPos + height, xPos:xPos + width]
+            return
+
+        rowSize = width * self.bytespp
+        for row in range(yPos, yPos + height):
+            start = self.offset(xPos, row)
+            self.view[start:start + rowSize] = source.view[start:start + rowSize]
+
+    def resized(self, width: int, height: int) -> "RFBFramebuffer":
+        """
+        returns a framebuffer of the new size containing
+        the part of this one which still fits
+        """
+        framebuffer = RFBFramebuffer(width, height, self.bytespp)
+
+        rowSize = min(width, self.width) * self.bytespp
+        for row in range(min(height, self.height)):
+            src = self.offset(0, row)
+            dst = framebuffer.offset(0, row)
+            framebuffer.view[dst:dst + rowSize] = self.view[src:src + rowSize]
+
+        return framebuffer
+
+    def __str__(self) -> str:
+        return f"{self.width}x{self.height} ({self.bytespp} bytes per pixel)"
+
+class RFBPixelConverter:
+    """
+    Converts rectangles of a framebuffer in a pixel format Qt can't
+    display directly into a 32 bit framebuffer in QImage.Format_RGB32.
+    8 and 16 bit formats go through a lookup table of all pixel values,
+    32 bit ones are converted channel by channel.
+
+    Pixels of formats without truecolor are indices into colorMap,
+    a list of 0xffRRGGBB values
+    """
+    def __init__(self, pixformat: RFBPixelformat, colorMap: list = None):
+        self.pixformat = pixformat
+
+        order = ">" if pixformat.bigendian else "<"
+        self._dtype = f"{order}u{pixformat.bytespp}"
+        self._swap = pixformat.bytespp > 1 and bool(pixformat.bigendian) != HOST_BIGENDIAN
+
+        colors = None
+        if not pixformat.truecolor:
+            # colour maps have up to 65536 entries, unset ones are black
+            size = 1 << min(pixformat.bitspp, 16)
+            colors = (list(colorMap or []) + [0xff000000] * size)[:size]
+        elif pixformat.bitspp <= 16:
+            colors = [pixformat.toRGB(pixel) for pixel in range(1 << pixformat.bitspp)]
+
+        self._table = None
+        if colors is not None:
+            if np is not None:
+                self._table = np.array(colors, np.uint32)
+            else:
+                self._table = [s.pack("=I", color) for color in colors]
+
+    def __call__(self, source: RFBFramebuffer, target: RFBFramebuffer,
+            xPos: int, yPos: int, width: int, height: int):
+        if target.array is not None:
+            self._convertArray(source, target, xPos, yPos, width, height)
+            return
+
+        rowSize = width * source.bytespp
+        for row in range(yPos, yPos + height):
+            start = source.offset(xPos, row)
+            pixels = self._convertRow(source.view[start:start + rowSize])
+
+            start = target.offset(xPos, row)
+            target.view[start:start + width * 4] = pixels
+
+    def _convertArray(self, source: RFBFramebuffer, target: RFBFramebuffer,
+            xPos: int, yPos: int, width: int, height: int):
+        pixels = np.ascontiguousarray(
+            source.array[yPos:yPos + height, xPos:xPos + width]
+        ).view(self._dtype)[..., 0]
+
+        if self._table is not None:
+            colors = self._table[pixels]
+        else:
+            pf = self.pixformat
+            pixels = pixels.astype(np.uint32)
+            colors = np.full(pixels.shape, 0xff000000, np.uint32)
+            for shift, maximum, position in (
+                    (pf.redshift, pf.redmax, 16),
+                    (pf.greenshift, pf.greenmax, 8),
+                    (pf.blueshift, pf.bluemax, 0)):
+                if maximum:
+                    channel = (pixels >> shift) & maximum
+                    colors |= (channel * 255 // maximum) << position
+
+        target.array[yPos:yPos + height, xPos:xPos + width] = \
+            colors.view(np.uint8).reshape(height, width, 4)
+
+    def _convertRow(self, row: memoryview) -> bytes:
+        pixels = array({1: "B", 2: "H", 4: "I"}[self.pixformat.bytespp])
+        pixels.frombytes(row)
+        if self._swap:
+            pixels.byteswap()
+
+        if self._table is not None:
+            table = self._table
+            return b"".join(table[pixel] for pixel in pixels)
+
+        toRGB = self.pixformat.toRGB
+        return array("I", (toRGB(pixel) for pixel in pixels)).tobytes()
+
+class RFBTripleBuffer:
+    """
+    Hands finished frames from the RFB thread (writer) to the GUI thread
+    (reader) without one ever waiting for the other.
+
+    The writer decodes into its own framebuffer and publishes the changed
+    rectangles into a spare buffer, which is then swapped with the ready
+    one. The reader takes the ready buffer whenever it paints. Only the
+    buffer indices are swapped under the lock, and every buffer keeps the
+    list of rectangles it is missing, so only changed areas get copied.
+
+    A converter (see RFBPixelConverter) is used instead of plain copies
+    when the buffers have a different pixel format than the source.
+    """
+    # more pending rectangles than this are merged into a full update
+    MAX_PENDING = 64
+
+    def __init__(self, width: int, height: int, bytespp: int,
+            converter: RFBPixelConverter = None):
+        self.width = width
+        self.height = height
+        self.converter = converter
+        self.buffers = [RFBFramebuffer(width, height, bytespp) for _ in range(3)]
+
+        full = (0, 0, width, height)
+        self._pending = [[full] for _ in self.buffers]
+        self._readerDirty = [full]
+
+        self._write, self._ready, self._read = 0, 1, 2
+        self._fresh = False
+        self._lock = Lock()
+
+    def _addPending(self, index: int, rects: list):
+        pending = self._pending[index]
+        pending.extend(rects)
+        if len(pending) > self.MAX_PENDING:
+            self._pending[index] = [(0, 0, self.width, self.height)]
+
+    def publish(self, source: RFBFramebuffer, rects: list):
+        """
+        writer side, rects (x, y, width, height) changed in source
+        since the last call
+        """
+        write = self._write
+        for index in range(len(self.buffers)):
+            self._addPending(index, rects)
+
+        buffer = self.buffers[write]
+        for rect in self._pending[write]:
+            if self.converter is None:
+                buffer.blit(source, *rect)
+            else:
+                self.converter(source, buffer, *rect)
+        self._pending[write] = list()
+
+        with self._lock:
+            self._write, self._ready = self._ready, write
+            self._fresh = True
+            self._readerDirty.extend(rects)
+            if len(self._readerDirty) > self.MAX_PENDING:
+                self._readerDirty = [(0, 0, self.width, self.height)]
+
+    def acquire(self) -> tuple:
+        """
+        reader side, returns the index of the newest frame and the
+        rectangles changed since the previous call. The buffer stays
+        untouched until the next call.
+        """
+        with self._lock:
+            if self._fresh:
+                self._read, self._ready = self._ready, self._read
+                self._fresh = False
+            dirty, self._readerDirty = self._readerDirty, list()
+            return self._read, dirty
+
+class RFBThroughput:
+    """
+    Estimates the throughput of the connection from the amount of data
+    received and the time spent waiting for it. Small samples mostly
+    measure latency, so they are ignored.
+    """
+    MIN_SAMPLE_SIZE = 16*1024
+    # weight of a new sample in the estimate
+    SMOOTHING = 0.3
+
+    def __init__(self):
+        self.kbps: float = None
+
+    def addSample(self, size: int, seconds: float) -> bool:
+        """
+        returns whether the sample changed the estimate
+        """
+        if size < self.MIN_SAMPLE_SIZE:
+            return False
+
+        # no waiting at all means the link is not what limits us
+        kbps = size * 8 / 1000 / max(seconds, 1e-3)
+        if self.kbps is None:
+            self.kbps = kbps
+        else:
+            self.kbps += self.SMOOTHING * (kbps - self.kbps)
+        return True
+
 class RFBInput:
 
     # thanks to ken3 (https://github.com/ken3) for this
@@ -6,7 +6,7 @@ import logging
 from PyQt5.QtWidgets import QApplication, QMainWindow
 from PyQt5.QtGui import QKeyEvent
 #from qvncwidget import QVNCWidget
-from qvncwidget.qvncwidget import QVNCWidget, QVNCWidgetGL
+from qvncwidget.qvncwidget import QVNCWidget
 
 log = logging.getLogger("testing")
 
@@ -20,12 +20,12 @@ class Window(QMainWindow):
     def initUI(self):
         self.setWindowTitle("QVNCWidget")
 
-        #self.vnc = QVNCWidgetGL(
         self.vnc = QVNCWidget(
             parent=self,
             host="127.0.0.1", port=5900,
             password="1234",
-            readOnly=True
+            readOnly=True,
+            #backend=QVNCWidget.BACKEND_OPENGL
         )
         
         self.setCentralWidget(self.vnc)
@@ -0,0 +1,586 @@
+"""
+Round trip tests of the decoders, rectangles are encoded here and fed
+to the decoders without a connection
+"""
+
+from concurrent import futures
+import os
+import random
+import struct
+import zlib
+
+import pytest
+
+from qvncwidget.rfb import RFBClient, CursorDecoder, _cpixelPadding
+from qvncwidget.rfbhelpers import RFBPixelformat, RFBRectangle
+import qvncwidget.rfbconstants as c
+
+PIXEL_FORMATS = {
+    "32bpp": RFBPixelformat.getRGB32(),
+    "24bit depth": RFBPixelformat.getRGB24(),
+    "16bpp": RFBPixelformat.getRGB16(),
+    "8bpp": RFBPixelformat(bpp=8, depth=8, redmax=7, greenmax=7, bluemax=3,
+                           redshift=0, greenshift=3, blueshift=6),
+}
+
+class Client(RFBClient):
+    def __init__(self, width: int, height: int, pixformat: RFBPixelformat):
+        super().__init__("localhost")
+        self.vncWidth, self.vncHeight = width, height
+        self.pixformat = pixformat
+        self._allocFramebuffer()
+        for decoder in self.decoders.values():
+            decoder.reset()
+        self.changed = list()
+
+    def onFramebufferChanged(self, *rect):
+        self.changed.append(rect)
+
+    def decode(self, encoding: int, rect: tuple, data: bytes):
+        """
+        decodes one rectangle, data has to be used up completely
+        """
+        parser = self.decoders[encoding].decode(self, RFBRectangle(*rect))
+        pos = 0
+        if parser is not None:
+            try:
+                request = next(parser)
+                while True:
+                    if type(request) is int:
+                        chunk = data[pos:pos + request]
+                        assert len(chunk) == request, "decoder read past the end"
+                        pos += request
+                        request = parser.send(chunk)
+                    elif isinstance(request, futures.Future):
+                        futures.wait((request,))
+                        request = next(parser)
+                    else:
+                        request[:] = data[pos:pos + len(request)]
+                        pos += len(request)
+                        request = next(parser)
+            except StopIteration:
+                pass
+        self._flushDeferred()
+        assert pos == len(data), "decoder left data unread"
+
+class Screen:
+    """
+    reference framebuffer, list of rows of pixel bytes
+    """
+    def __init__(self, width: int, height: int, bytespp: int):
+        self.width, self.height, self.bytespp = width, height, bytespp
+        self.rows = [[bytes(bytespp)] * width for _ in range(height)]
+
+    def randomize(self):
+        for row in self.rows:
+            for x in range(self.width):
+                row[x] = os.urandom(self.bytespp)
+
+    def fill(self, xPos, yPos, width, height, pixel: bytes):
+        for y in range(yPos, yPos + height):
+            self.rows[y][xPos:xPos + width] = [pixel] * width
+
+    def get(self, xPos, yPos, width, height) -> list:
+        return [self.rows[y][xPos:xPos + width] for y in range(yPos, yPos + height)]
+
+    def put(self, xPos, yPos, pixels: list):
+        for y, row in enumerate(pixels):
+            self.rows[yPos + y][xPos:xPos + len(row)] = row
+
+    def data(self) -> bytes:
+        return b"".join(b"".join(row) for row in self.rows)
+
+def randomPixels(width: int, height: int, bytespp: int, colors: int = None) -> list:
+    palette = [os.urandom(bytespp) for _ in range(colors)] if colors else None
+    return [[palette[int.from_bytes(os.urandom(2), "big") % colors] if palette
+             else os.urandom(bytespp) for _ in range(width)] for _ in range(height)]
+
+def rawData(pixels: list) -> bytes:
+    return b"".join(b"".join(row) for row in pixels)
+
+@pytest.fixture(params=list(PIXEL_FORMATS))
+def pixformat(request) -> RFBPixelformat:
+    return PIXEL_FORMATS[request.param]
+
+def newClient(pixformat, width=40, height=30):
+    client = Client(width, height, pixformat)
+    screen = Screen(width, height, pixformat.bytespp)
+    screen.randomize()
+    client.framebuffer.putRect(0, 0, width, height, screen.data())
+    return client, screen
+
+# ------------------------------------------------------------------
+## CopyRect
+# ------------------------------------------------------------------
+
+@pytest.mark.parametrize("src, dst", [
+    ((0, 0), (10, 5)),      # overlapping, moving down
+    ((10, 5), (0, 0)),      # overlapping, moving up
+    ((3, 4), (20, 4)),      # same rows
+    ((0, 0), (25, 18)),     # apart
+])
+def test_copyrect(pixformat, src, dst):
+    client, screen = newClient(pixformat)
+    width, height = 15, 12
+
+    screen.put(*dst, screen.get(*src, width, height))
+    client.decode(c.ENC_COPYRECT, (*dst, width, height), struct.pack("!HH", *src))
+
+    assert bytes(client.framebuffer.data) == screen.data()
+    assert client.changed == [(*dst, width, height)]
+
+# ------------------------------------------------------------------
+## TRLE / ZRLE
+# ------------------------------------------------------------------
+
+# subencodings used for the tiles one after another, tuples are
+# (subencoding, palette size), 127 and 129 reuse the previous palette
+TRLE_TILES = [
+    (0, 0), (1, 1), (2, 2), (127, 2), (3, 3), (4, 4), (5, 5),
+    (128, 0), (128 + 2, 2), (129, 2), (128 + 60, 60), (129, 60),
+    (16, 16), (127, 16),
+]
+
+def _runLength(run: int) -> bytes:
+    run -= 1
+    return b"\xff" * (run // 255) + bytes((run % 255,))
+
+def _packIndices(indices: list, width: int, bits: int) -> bytes:
+    data = bytearray()
+    for row in range(len(indices) // width):
+        value, count = 0, 0
+        for index in indices[row*width:(row + 1)*width]:
+            value = value << bits | index
+            count += bits
+            if count == 8:
+                data.append(value)
+                value, count = 0, 0
+        if count:
+            data.append(value << (8 - count))
+    return bytes(data)
+
+def _randomRuns(size: int, values: int, maxRun: int) -> list:
+    indices = list()
+    while len(indices) < size:
+        indices += [random.randrange(values)] * random.choice((1, 2, 7, maxRun))
+    return indices[:size]
+
+def encodeTRLE(screen: Screen, pixformat: RFBPixelformat,
+        rect: tuple, tileSize: int) -> bytes:
+    """
+    encodes rect of screen and replaces the pixels of screen with the
+    ones the decoder will produce (the padding byte of CPIXELs is 0)
+    """
+    padding = _cpixelPadding(pixformat)
+    cpixelSize = screen.bytespp if padding is None else 3
+
+    def expand(cpixel: bytes) -> bytes:
+        if padding is None:
+            return cpixel
+        return cpixel[:padding] + b"\0" + cpixel[padding:]
+
+    xPos, yPos, width, height = rect
+    data = bytearray()
+    palette = None
+    tiles = 0
+
+    for ty in range(yPos, yPos + height, tileSize):
+        th = min(tileSize, yPos + height - ty)
+        for tx in range(xPos, xPos + width, tileSize):
+            tw = min(tileSize, xPos + width - tx)
+            subencoding, colors = TRLE_TILES[tiles % len(TRLE_TILES)]
+            tiles += 1
+            size = tw * th
+
+            if subencoding not in (127, 129):
+                palette = [os.urandom(cpixelSize) for _ in range(max(colors, 1))]
+            data.append(subencoding)
+
+            if subencoding == 0:
+                cpixels = [os.urandom(cpixelSize) for _ in range(size)]
+                data += b"".join(cpixels)
+
+            elif subencoding == 1:
+                cpixels = palette * size
+                data += palette[0]
+
+            elif subencoding <= 16 or subencoding == 127:
+                if subencoding != 127:
+                    data += b"".join(palette)
+                bits = 1 if len(palette) == 2 else 2 if len(palette) <= 4 else 4
+                indices = [random.randrange(len(palette)) for _ in range(size)]
+                cpixels = [palette[i] for i in indices]
+                data += _packIndices(indices, tw, bits)
+
+            elif subencoding == 128:
+                palette = [os.urandom(cpixelSize) for _ in range(5)]
+                indices = _randomRuns(size, 5, 300)
+                cpixels = [palette[i] for i in indices]
+                start = 0
+                while start < size:
+                    end = start
+                    while end < size and indices[end] == indices[start]:
+                        end += 1
+                    data += palette[indices[start]] + _runLength(end - start)
+                    start = end
+
+            else:
+                if subencoding != 129:
+                    data += b"".join(palette)
+                indices = _randomRuns(size, len(palette), 300)
+                cpixels = [palette[i] for i in indices]
+                start = 0
+                while start < size:
+                    end = start
+                    while end < size and indices[end] == indices[start]:
+                        end += 1
+                    if end - start == 1:
+                        data.append(indices[start])
+                    else:
+                        data.append(indices[start] | 128)
+                        data += _runLength(end - start)
+                    start = end
+
+            screen.put(tx, ty, [
+                [expand(p) for p in cpixels[row*tw:(row + 1)*tw]] for row in range(th)])
+
+    return bytes(data)
+
+@pytest.mark.parametrize("rect", [(0, 0, 130, 80), (5, 3, 70, 61)])
+def test_trle(pixformat, rect):
+    client, screen = newClient(pixformat, 130, 80)
+    for _ in range(2):
+        data = encodeTRLE(screen, pixformat, rect, 16)
+        client.decode(c.ENC_TRLE, rect, data)
+        assert bytes(client.framebuffer.data) == screen.data()
+
+@pytest.mark.parametrize("rect", [(0, 0, 130, 80), (5, 3, 70, 61)])
+def test_zrle(pixformat, rect):
+    client, screen = newClient(pixformat, 130, 80)
+    # one zlib stream for the whole connection
+    stream = zlib.compressobj()
+    for _ in range(2):
+        data = stream.compress(encodeTRLE(screen, pixformat, rect, 64))
+        data += stream.flush(zlib.Z_SYNC_FLUSH)
+        client.decode(c.ENC_ZRLE, rect, struct.pack("!I", len(data)) + data)
+        assert bytes(client.framebuffer.data) == screen.data()
+
+# ------------------------------------------------------------------
+## Hextile / ZlibHex
+# ------------------------------------------------------------------
+
+HEXTILE_TILES = [
+    c.HEXTILE_RAW,
+    c.HEXTILE_BACKGROUND,
+    0, # previous background
+    c.HEXTILE_BACKGROUND | c.HEXTILE_FOREGROUND | c.HEXTILE_ANY_SUBRECTS,
+    c.HEXTILE_ANY_SUBRECTS, # previous colours
+    c.HEXTILE_BACKGROUND | c.HEXTILE_ANY_SUBRECTS | c.HEXTILE_SUBRECTS_COLOURED,
+    c.HEXTILE_FOREGROUND | c.HEXTILE_ANY_SUBRECTS,
+]
+
+def encodeHextile(screen: Screen, rect: tuple, zlibHex: bool = False,
+        rawStream=None, hexStream=None) -> bytes:
+    """
+    encodes rect of screen with random tiles and puts them into screen,
+    for ZlibHex every second tile is compressed
+    """
+    bytespp = screen.bytespp
+    xPos, yPos, width, height = rect
+    data = bytearray()
+    background = foreground = None
+    tiles = 0
+
+    for ty in range(yPos, yPos + height, 16):
+        th = min(16, yPos + height - ty)
+        for tx in range(xPos, xPos + width, 16):
+            tw = min(16, xPos + width - tx)
+            subencoding = HEXTILE_TILES[tiles % len(HEXTILE_TILES)]
+            compress = zlibHex and tiles % 2 == 1
+            tiles += 1
+
+            if subencoding & c.HEXTILE_RAW:
+                pixels = randomPixels(tw, th, bytespp)
+                screen.put(tx, ty, pixels)
+                if compress:
+                    body = rawStream.compress(rawData(pixels))
+                    body += rawStream.flush(zlib.Z_SYNC_FLUSH)
+                    data.append(c.HEXTILE_ZLIB_RAW)
+                    data += struct.pack("!H", len(body)) + body
+                else:
+                    data.append(subencoding)
+                    data += rawData(pixels)
+                continue
+
+            body = bytearray()
+            if subencoding & c.HEXTILE_BACKGROUND:
+                background = os.urandom(bytespp)
+                body += background
+            if subencoding & c.HEXTILE_FOREGROUND:
+                foreground = os.urandom(bytespp)
+                body += foreground
+            screen.fill(tx, ty, tw, th, background)
+
+            if subencoding & c.HEXTILE_ANY_SUBRECTS:
+                count = random.randint(1, 20)
+                body.append(count)
+                for _ in range(count):
+                    sx, sy = random.randrange(tw), random.randrange(th)
+                    sw, sh = random.randint(1, tw - sx), random.randint(1, th - sy)
+                    pixel = foreground
+                    if subencoding & c.HEXTILE_SUBRECTS_COLOURED:
+                        pixel = os.urandom(bytespp)
+                        body += pixel
+                    body += bytes((sx << 4 | sy, (sw - 1) << 4 | (sh - 1)))
+                    screen.fill(tx + sx, ty + sy, sw, sh, pixel)
+
+            if compress:
+                body = hexStream.compress(bytes(body)) + hexStream.flush(zlib.Z_SYNC_FLUSH)
+                data.append(subencoding | c.HEXTILE_ZLIB_HEX)
+                data += struct.pack("!H", len(body)) + body
+            else:
+                data.append(subencoding)
+                data += body
+
+    return bytes(data)
+
+@pytest.mark.parametrize("rect", [(0, 0, 130, 80), (5, 3, 70, 61)])
+def test_hextile(pixformat, rect):
+    client, screen = newClient(pixformat, 130, 80)
+    data = encodeHextile(screen, rect)
+    client.decode(c.ENC_HEXTILE, rect, data)
+    assert bytes(client.framebuffer.data) == screen.data()
+
+@pytest.mark.parametrize("rect", [(0, 0, 130, 80), (5, 3, 70, 61)])
+def test_zlibhex(pixformat, rect):
+    client, screen = newClient(pixformat, 130, 80)
+    rawStream, hexStream = zlib.compressobj(), zlib.compressobj()
+    for _ in range(2):
+        data = encodeHextile(screen, rect, True, rawStream, hexStream)
+        client.decode(c.ENC_ZLIBHEX, rect, data)
+        assert bytes(client.framebuffer.data) == screen.data()
+
+# ------------------------------------------------------------------
+## Tight
+# ------------------------------------------------------------------
+
+def _components(pixformat: RFBPixelformat) -> list:
+    return [
+        (pixformat.redmax, pixformat.redshift),
+        (pixformat.greenmax, pixformat.greenshift),
+        (pixformat.bluemax, pixformat.blueshift),
+    ]
+
+def _packPixel(pixformat: RFBPixelformat, rgb: tuple) -> bytes:
+    value = 0
+    for component, (_, shift) in zip(rgb, _components(pixformat)):
+        value |= component << shift
+    return value.to_bytes(pixformat.bytespp, "big" if pixformat.bigendian else "little")
+
+def _isRGB(pixformat: RFBPixelformat) -> bool:
+    # TPIXELs are 3 bytes of red, green, blue
+    return pixformat.bitspp == 32 and pixformat.depth == 24
+
+def randomColor(pixformat: RFBPixelformat) -> tuple:
+    """
+    returns a random (tpixel, pixel, components) in the given format
+    """
+    rgb = tuple(random.randint(0, cmax) for cmax, _ in _components(pixformat))
+    pixel = _packPixel(pixformat, rgb)
+    return (bytes(rgb) if _isRGB(pixformat) else pixel), pixel, rgb
+
+def _compactLength(length: int) -> bytes:
+    data = bytearray((length & 0x7f,))
+    if length > 0x7f:
+        data[-1] |= 0x80
+        data.append(length >> 7 & 0x7f)
+        if length > 0x3fff:
+            data[-1] |= 0x80
+            data.append(length >> 14)
+    return bytes(data)
+
+class TightEncoder:
+    def __init__(self):
+        self.streams = [zlib.compressobj() for _ in range(4)]
+
+    def data(self, data: bytes, stream: int) -> bytes:
+        if len(data) < c.TIGHT_MIN_TO_COMPRESS:
+            return data
+        data = self.streams[stream].compress(data) + self.streams[stream].flush(zlib.Z_SYNC_FLUSH)
+        return _compactLength(len(data)) + data
+
+    def reset(self, stream: int) -> int:
+        self.streams[stream] = zlib.compressobj()
+        return 1 << stream
+
+def _gradientData(pixformat: RFBPixelformat, components: list, width: int) -> bytes:
+    """
+    differences to the prediction of the Tight gradient filter
+    """
+    maxes = [cmax for cmax, _ in _components(pixformat)]
+    data = bytearray()
+    for i, pixel in enumerate(components):
+        x, y = i % width, i // width
+        left = components[i - 1] if x else (0, 0, 0)
+        above = components[i - width] if y else (0, 0, 0)
+        aboveLeft = components[i - width - 1] if x and y else (0, 0, 0)
+        diff = list()
+        for j, cmax in enumerate(maxes):
+            prediction = above[j] if not x else \
+                max(0, min(left[j] + above[j] - aboveLeft[j], cmax))
+            diff.append((pixel[j] - prediction) & cmax)
+        data += bytes(diff) if _isRGB(pixformat) else _packPixel(pixformat, diff)
+    return bytes(data)
+
+@pytest.mark.parametrize("width, height", [(40, 30), (3, 2)])
+def test_tight(pixformat, width, height):
+    client, screen = newClient(pixformat, 40, 30)
+    encoder = TightEncoder()
+    rect = (0, 0, width, height)
+    size = width * height
+
+    def check(data: bytes):
+        client.decode(c.ENC_TIGHT, rect, data)
+        assert bytes(client.framebuffer.data) == screen.data()
+
+    # fill
+    tpixel, pixel, _ = randomColor(pixformat)
+    screen.fill(*rect, pixel)
+    check(bytes((c.TIGHT_FILL << 4,)) + tpixel)
+
+    for stream in range(4):
+        reset = encoder.reset(stream) if stream == 2 else 0
+
+        # copy filter, explicit and implicit
+        colors = [randomColor(pixformat) for _ in range(size)]
+        screen.put(0, 0, [[p for _, p, _ in colors[row*width:(row + 1)*width]]
+                          for row in range(height)])
+        body = encoder.data(b"".join(t for t, _, _ in colors), stream)
+        if stream % 2:
+            check(bytes(((stream | c.TIGHT_EXPLICIT_FILTER) << 4 | reset,
+                         c.TIGHT_FILTER_COPY)) + body)
+        else:
+            check(bytes((stream << 4 | reset,)) + body)
+
+        # palette filter with 2 (1 bit per index) and more colors
+        for numColors in (2, 7):
+            palette = [randomColor(pixformat) for _ in range(numColors)]
+            indices = [random.randrange(numColors) for _ in range(size)]
+            screen.put(0, 0, [[palette[i][1] for i in indices[row*width:(row + 1)*width]]
+                              for row in range(height)])
+            packed = _packIndices(indices, width, 1) if numColors == 2 else bytes(indices)
+            check(bytes(((stream | c.TIGHT_EXPLICIT_FILTER) << 4, c.TIGHT_FILTER_PALETTE,
+                         numColors - 1))
+                  + b"".join(t for t, _, _ in palette) + encoder.data(packed, stream))
+
+        # gradient filter
+        colors = [randomColor(pixformat) for _ in range(size)]
+        screen.put(0, 0, [[p for _, p, _ in colors[row*width:(row + 1)*width]]
+                          for row in range(height)])
+        body = _gradientData(pixformat, [rgb for _, _, rgb in colors], width)
+        check(bytes(((stream | c.TIGHT_EXPLICIT_FILTER) << 4, c.TIGHT_FILTER_GRADIENT))
+              + encoder.data(body, stream))
+
+def test_tight_jpeg(pixformat):
+    from PyQt5.QtCore import QBuffer, QByteArray, QIODevice
+    from PyQt5.QtGui import QImage, QColor
+
+    width, height = 40, 30
+    client, _ = newClient(pixformat, width, height)
+
+    # flat blocks survive JPEG compression almost unchanged
+    blocks = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (200, 200, 200)]
+    image = QImage(width, height, QImage.Format_RGB888)
+    for i, color in enumerate(blocks):
+        for y in range(height):
+            for x in range(i*10, (i + 1)*10):
+                image.setPixelColor(x, y, QColor(*color))
+    jpeg = QByteArray()
+    buffer = QBuffer(jpeg)
+    buffer.open(QIODevice.WriteOnly)
+    assert image.save(buffer, "JPEG", 100)
+    data = bytes(jpeg)
+
+    client.decode(c.ENC_TIGHT, (0, 0, width, height),
+                  bytes((c.TIGHT_JPEG << 4,)) + _compactLength(len(data)) + data)
+    assert client.changed[-1] == (0, 0, width, height)
+
+    fb = client.framebuffer
+    order = "big" if pixformat.bigendian else "little"
+    for i, color in enumerate(blocks):
+        offset = fb.offset(i*10 + 5, 15)
+        pixel = int.from_bytes(fb.data[offset:offset + fb.bytespp], order)
+        rgb = pixformat.toRGB(pixel)
+        decoded = (rgb >> 16 & 0xff, rgb >> 8 & 0xff, rgb & 0xff)
+        for cmax, expected, value in zip(
+                (pixformat.redmax, pixformat.greenmax, pixformat.bluemax), color, decoded):
+            assert abs(expected - value) <= 255 // cmax + 8, (color, decoded)
+
+# ------------------------------------------------------------------
+## Raw / RRE / CoRRE / Zlib
+# ------------------------------------------------------------------
+
+@pytest.mark.parametrize("rect", [(0, 0, 40, 30), (0, 7, 40, 5), (5, 3, 20, 11)])
+def test_raw(pixformat, rect):
+    client, screen = newClient(pixformat)
+    pixels = randomPixels(*rect[2:], pixformat.bytespp)
+    screen.put(*rect[:2], pixels)
+
+    client.decode(c.ENC_RAW, rect, rawData(pixels))
+    assert bytes(client.framebuffer.data) == screen.data()
+    assert client.changed == [rect]
+
+@pytest.mark.parametrize("encoding, entry", [(c.ENC_RRE, "!HHHH"), (c.ENC_CORRE, "!BBBB")])
+def test_rre(pixformat, encoding, entry):
+    client, screen = newClient(pixformat)
+    rect = (5, 3, 30, 20)
+    background = os.urandom(pixformat.bytespp)
+    screen.fill(*rect, background)
+
+    subrects = list()
+    for _ in range(25):
+        sx, sy = random.randrange(30), random.randrange(20)
+        subrect = (sx, sy, random.randint(1, 30 - sx), random.randint(1, 20 - sy))
+        pixel = os.urandom(pixformat.bytespp)
+        screen.fill(rect[0] + sx, rect[1] + sy, *subrect[2:], pixel)
+        subrects.append(pixel + struct.pack(entry, *subrect))
+
+    client.decode(encoding, rect,
+                  struct.pack("!I", len(subrects)) + background + b"".join(subrects))
+    assert bytes(client.framebuffer.data) == screen.data()
+
+def test_zlib(pixformat):
+    client, screen = newClient(pixformat)
+    stream = zlib.compressobj()
+    for rect in ((0, 0, 40, 30), (5, 3, 20, 11)):
+        pixels = randomPixels(*rect[2:], pixformat.bytespp, colors=4)
+        screen.put(*rect[:2], pixels)
+        data = stream.compress(rawData(pixels)) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+        client.decode(c.ENC_ZLIB, rect, struct.pack("!I", len(data)) + data)
+        assert bytes(client.framebuffer.data) == screen.data()
+
+# ------------------------------------------------------------------
+## Cursor
+# ------------------------------------------------------------------
+
+def test_cursor_not_advertised_by_default():
+    client = Client(40, 30, RFBPixelformat.getRGB32())
+    assert c.ENC_CURSOR not in client.supportedEncodings()
+
+    client.registerDecoder(CursorDecoder())
+    assert c.ENC_CURSOR in client.supportedEncodings()
+
+def test_cursor(pixformat):
+    client, screen = newClient(pixformat)
+    client.registerDecoder(CursorDecoder())
+    cursors = list()
+    client.onCursorUpdate = lambda *cursor: cursors.append(cursor)
+
+    pixels = rawData(randomPixels(11, 7, pixformat.bytespp))
+    mask = os.urandom(2 * 7)
+    client.decode(c.ENC_CURSOR, (3, 4, 11, 7), pixels + mask)
+
+    assert cursors == [(3, 4, 11, 7, pixels, mask)]
+    # the framebuffer is left alone
+    assert bytes(client.framebuffer.data) == screen.data()
@@ -0,0 +1,74 @@
+"""
+Tests of sending client messages through RFBWriter
+"""
+
+import socket
+import threading
+
+from qvncwidget.rfb import RFBClient, RFBWriter
+from qvncwidget.rfbhelpers import RFBPixelformat
+
+def test_writer_merges_queued_messages():
+    client, server = socket.socketpair()
+    writer = RFBWriter(client)
+
+    writer.hold()
+    writer.send(b"a")
+    writer.send(b"b", mergeKey=1)
+    writer.send(b"c", mergeKey=1)
+    writer.send(b"d")
+    writer.release()
+
+    server.settimeout(5)
+    assert server.recv(16) == b"acd"
+    writer.close()
+    client.close()
+    server.close()
+
+def test_writer_failure_shuts_down_connection():
+    client, server = socket.socketpair()
+    writer = RFBWriter(client)
+
+    # the other side does not take anything anymore
+    server.shutdown(socket.SHUT_RD)
+    writer.send(b"x")
+    writer._thread.join(5)
+
+    assert isinstance(writer.error, OSError)
+    # reading does not block forever
+    client.settimeout(5)
+    assert client.recv(1) == b""
+
+    # later messages are dropped
+    writer.send(b"y")
+    client.close()
+    server.close()
+
+def test_send_failure_reaches_onFatalError():
+    errors = list()
+
+    class Client(RFBClient):
+        def onFatalError(self, error: Exception):
+            errors.append(error)
+
+    client = Client("localhost")
+    client.connection, server = socket.socketpair()
+    client._writer = RFBWriter(client.connection)
+    client._wakeupSockets = socket.socketpair()
+    client.vncWidth, client.vncHeight = 40, 30
+    client.pixformat = RFBPixelformat.getRGB32()
+    client._allocFramebuffer()
+    client._connected = True
+
+    server.shutdown(socket.SHUT_RD)
+    mainLoop = threading.Thread(target=client._mainRequestLoop, daemon=True)
+    mainLoop.start()
+    # sending the first update request fails
+    mainLoop.join(5)
+
+    assert not mainLoop.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+
+    client._writer.close()
+    for sock in (client.connection, server, *client._wakeupSockets):
+        sock.close()